@@ -2,85 +2,2278 @@
 
 import time
 import io
+import os
+import hashlib
 import queue
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import json
-from collections import deque
+from collections import deque, OrderedDict
 from configparser import ConfigParser
 import argparse
 import sys
+import struct
+import socket
+import wave
+import functools
+from math import gcd
 
-import resampy
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
+from cffi import FFI
 from scipy.io import wavfile
-import sounddevice as sd
-import regex
+from scipy import signal
 from vosk import Model, KaldiRecognizer, SetLogLevel
 import ollama
+import httpx
+
+# PortAudio is only needed for the sounddevice audio backends
+try:
+    import sounddevice as sd
+except OSError:
+    sd = None
 
 #---------------------------------------------------------------------------------------------------
 # Classes
 
-class FixedSizeQueue:
+class ChatHistory:
     """
-    Fixed size array with FIFO
+    Conversation sent with each chat request: the preamble followed by the latest messages, kept
+    under a budget of (estimated) tokens and messages. Once either limit is passed, the oldest turns
+    are dropped in one go until the history is down to the low-water mark. Between those evictions
+    the start of the prompt stays the same, so Ollama can reuse the cache it built for the previous
+    turn instead of evaluating the whole conversation again. If `keep_dropped` is set, dropped
+    messages are kept until they are condensed into a summary (see HistorySummarizer), which is
+    sent after the preamble.
     """
-    def __init__(self, max_size, preamble=None):
-        self.queue = deque(maxlen=max_size)
-        self.preamble = {
-            "role": "system",
-            "content": preamble
-        }
+    CHARS_PER_TOKEN = 4         # Rough average for English text
+    TOKENS_PER_MESSAGE = 4      # Role and template tokens around each message
+
+    def __init__(
+        self,
+        max_tokens=0,
+        max_messages=0,
+        low_water=0.5,
+        preamble=None,
+        keep_dropped=False
+    ):
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.low_water = low_water
+        self.keep_dropped = keep_dropped
+        self.lock = threading.Lock()
+        self.messages = []
+        self.dropped = []
+        self.summary = ""
+        self.preamble = None
+        if preamble is not None:
+            self.preamble = {
+                "role": "system",
+                "content": preamble
+            }
+
+    @classmethod
+    def estimate_tokens(cls, messages):
+        """
+        Estimate how many tokens the messages take up in the prompt
+        """
+        return sum(
+            len(message["content"]) // cls.CHARS_PER_TOKEN + cls.TOKENS_PER_MESSAGE
+            for message in messages
+        )
+
+    def prefix(self):
+        """
+        Messages that go before the conversation: the preamble and the summary
+        """
+        prefix = []
+        if self.preamble is not None:
+            prefix.append(self.preamble)
+        if self.summary:
+            prefix.append({
+                "role": "system",
+                "content": f"Summary of the conversation so far: {self.summary}"
+            })
+
+        return prefix
+
+    def over(self, messages, fraction=1.0):
+        """
+        Return True if the messages (plus the prefix) are over the given fraction of the limits
+        """
+        if self.max_messages > 0 and len(messages) > fraction * self.max_messages:
+            return True
+        if self.max_tokens > 0:
+            tokens = self.estimate_tokens(self.prefix() + messages)
+            if tokens > fraction * self.max_tokens:
+                return True
+
+        return False
+
+    def trim(self, messages):
+        """
+        Return the number of oldest messages to drop to get down to the low-water mark, if the
+        messages are over the limits. Whole turns (a question and its reply) are dropped, oldest
+        first, so the history always starts with a question. The latest turn is always kept, even
+        if it is over the limits on its own.
+        """
+        if not self.over(messages):
+            return 0
+        starts = [i for i, message in enumerate(messages) if message["role"] == "user"]
+        for start in starts:
+            if start > 0 and not self.over(messages[start:], self.low_water):
+                return start
+
+        return starts[-1] if starts else 0
 
     def push(self, item):
-        self.queue.append(item)
+        with self.lock:
+            messages = self.messages + [item]
+            num = self.trim(messages)
+            self.messages = messages[num:]
+            if self.keep_dropped:
+                self.dropped += messages[:num]
+        if DEBUG and num > 0:
+            print(f"Dropped {num} messages from the chat history")
 
     def get(self):
-        if self.preamble is None:
-            return list(self.queue)
+        with self.lock:
+            return self.prefix() + self.messages
+
+    def clear(self):
+        with self.lock:
+            self.messages = []
+            self.dropped = []
+            self.summary = ""
+
+    def peek(self, item):
+        """
+        Return what get() would return after pushing item, without pushing it
+        """
+        with self.lock:
+            messages = self.messages + [item]
+            return self.prefix() + messages[self.trim(messages):]
+
+    def tokens(self):
+        """
+        Estimated number of tokens in the prompt
+        """
+        return self.estimate_tokens(self.get())
+
+    def take_dropped(self):
+        """
+        Return the current summary and the messages dropped since it was written
+        """
+        with self.lock:
+            return self.summary, list(self.dropped)
+
+    def set_summary(self, summary, num_dropped):
+        """
+        Replace the summary with one that covers the first `num_dropped` dropped messages
+        """
+        with self.lock:
+            self.summary = summary
+            del self.dropped[:num_dropped]
+
+class HistorySummarizer:
+    """
+    Condenses the messages dropped from the chat history into a short summary, in the background
+    while the assistant is idle. The request is aborted if the user starts talking, so it never
+    holds up a reply, and the messages are summarized next time instead.
+    """
+    PROMPT = (
+        "Summarize the conversation below in {max_words} words or fewer. Keep names, facts, and "
+        "anything the user asked you to remember. Reply with only the summary."
+    )
+
+    def __init__(self, chat_backend, msg_history, max_words=100):
+        self.chat_backend = chat_backend
+        self.msg_history = msg_history
+        self.max_words = max_words
+        self.thread = None
+        self.stream = None
+
+    def start(self):
+        """
+        Start summarizing in the background if any messages were dropped
+        """
+        summary, dropped = self.msg_history.take_dropped()
+        if not dropped or (self.thread is not None and self.thread.is_alive()):
+            return
+        lines = [self.PROMPT.format(max_words=self.max_words), ""]
+        if summary:
+            lines.append(f"Earlier summary: {summary}")
+        for message in dropped:
+            lines.append(f"{message['role'].capitalize()}: {message['content']}")
+        self.stream = self.chat_backend.chat(
+            [{"role": "user", "content": "\n".join(lines)}],
+            max_tokens=2 * self.max_words
+        )
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(self.stream, len(dropped)),
+            daemon=True
+        )
+        self.thread.start()
+
+    def run(self, stream, num_dropped):
+        """
+        Read the summary and store it in the history (unless it was stopped)
+        """
+        timestamp = time.monotonic()
+        try:
+            parts = [chunk["message"]["content"] for chunk in stream]
+        except Exception as e:
+            print(f"Failed to summarize chat history: {e}", file=sys.stderr)
+            return
+        if stream.closed:
+            return
+        summary = "".join(parts).strip()
+        if summary:
+            self.msg_history.set_summary(summary, num_dropped)
+            if DEBUG:
+                print(
+                    f"Summarized {num_dropped} messages in "
+                    f"{round(time.monotonic() - timestamp, 1)} sec: {summary}"
+                )
+
+    def stop(self):
+        """
+        Abort the summary (if one is being written) and wait for the thread to finish
+        """
+        if self.thread is not None:
+            self.stream.close()
+            self.thread.join()
+            self.thread = None
+
+class PhraseMatcher:
+    """
+    Matches transcripts against the configured phrases (e.g. wake phrases and actions). Phrases are
+    normalized and indexed once, so exact and sound-alike matches are dictionary lookups. Anything
+    else is compared by edit distance (of the text and of how it sounds), which catches small
+    mishearings without having to list every variant in the config.
+    """
+    CODES = {
+        c: code
+        for letters, code in [
+            ("bfpv", "1"),
+            ("cgjkqsxz", "2"),
+            ("dt", "3"),
+            ("l", "4"),
+            ("mn", "5"),
+            ("r", "6")
+        ]
+        for c in letters
+    }
+    KEY_WEIGHT = 0.9            # Sounding alike is not quite as good as being spelled alike
+    FUZZY_MIN_CHARS = 6         # Shorter phrases must match exactly ("stoop" is not "stop")
+    KEY_MIN_SIMILARITY = 0.5    # Sound-alike matches must still be spelled somewhat alike
+
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self.entries = []
+        self.by_text = {}
+        self.by_key = {}
+        self.lengths = set()
+
+    @staticmethod
+    def normalize(text):
+        """
+        Split text into lowercase words, without punctuation or tokens like "[unk]"
+        """
+        words = []
+        for word in text.lower().split():
+            if word.startswith("["):
+                continue
+            word = "".join(c for c in word if c.isalnum())
+            if word:
+                words.append(word)
+
+        return words
+
+    @classmethod
+    def phonetic(cls, words):
+        """
+        Rough key for how words sound (like Soundex): consonants are grouped by sound, and vowels
+        are dropped unless they start a word
+        """
+        keys = []
+        for word in words:
+            key = "a" if word[0] in "aeiou" else word[0] if word[0] in "hwy" else ""
+            last = ""
+            for c in word:
+                code = cls.CODES.get(c, "")
+                if code and code != last:
+                    key += code
+                last = code
+            keys.append(key)
+
+        return " ".join(keys)
+
+    @staticmethod
+    def distance(a, b, max_dist):
+        """
+        Edit (Levenshtein) distance between two strings, or max_dist + 1 if it is more than that
+        """
+        if abs(len(a) - len(b)) > max_dist:
+            return max_dist + 1
+        prev = list(range(len(b) + 1))
+        for i, ca in enumerate(a, 1):
+            cur = [i] + [0] * len(b)
+            for j, cb in enumerate(b, 1):
+                cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if min(cur) > max_dist:
+                return max_dist + 1
+            prev = cur
+
+        return prev[-1]
+
+    def similarity(self, a, b, min_similarity):
+        """
+        Similarity of two strings from 0.0 to 1.0 (or 0.0 if it is less than min_similarity)
+        """
+        length = max(len(a), len(b), 1)
+        max_dist = int((1.0 - min_similarity) * length + 1e-9)
+        dist = self.distance(a, b, max_dist)
+        if dist > max_dist:
+            return 0.0
+
+        return 1.0 - dist / length
+
+    def sounds_alike_ok(self, text, phrase_text):
+        """
+        Return True if text may match a phrase by how it sounds. The key drops all vowels, so it is
+        only trusted for longer phrases, and only if the text is also spelled somewhat alike (e.g.
+        "setup" must not match "stop").
+        """
+        if self.KEY_WEIGHT < self.threshold or len(phrase_text) < self.FUZZY_MIN_CHARS:
+            return False
+
+        return self.similarity(text, phrase_text, self.KEY_MIN_SIMILARITY) > 0.0
+
+    def add(self, action, phrases):
+        """
+        Index the phrases that trigger an action
+        """
+        for phrase in phrases:
+            words = self.normalize(phrase)
+            if not words:
+                continue
+            text = " ".join(words)
+            key = self.phonetic(words)
+            entry = (action, phrase, len(words), text, key)
+            self.entries.append(entry)
+            self.by_text.setdefault(text, entry)
+            self.by_key.setdefault(key, entry)
+            self.lengths.add(len(words))
+
+    def match(self, text, suffix=False):
+        """
+        Find the phrase that best matches the text (or just the end of it if `suffix` is set, e.g.
+        for a wake phrase at the end of a partial result). Returns (action, phrase, confidence),
+        with action and phrase set to None if nothing is close enough.
+        """
+        words = self.normalize(text)
+        candidates = {}
+        lengths = {n + d for n in self.lengths for d in (-1, 0, 1)} if suffix else [len(words)]
+        for length in lengths:
+            if 0 < length <= len(words):
+                candidates[length] = words[-length:]
+
+        # Exact and sound-alike matches
+        for length, candidate in candidates.items():
+            entry = self.by_text.get(" ".join(candidate))
+            if entry is not None:
+                return entry[0], entry[1], 1.0
+        for length, candidate in candidates.items():
+            entry = self.by_key.get(self.phonetic(candidate))
+            if entry is not None and self.sounds_alike_ok(" ".join(candidate), entry[3]):
+                return entry[0], entry[1], self.KEY_WEIGHT
+
+        # Closest by edit distance
+        best = (None, None, 0.0)
+        for length, candidate in candidates.items():
+            text = " ".join(candidate)
+            key = self.phonetic(candidate)
+            for action, phrase, num_words, phrase_text, phrase_key in self.entries:
+                if suffix and abs(num_words - length) > 1:
+                    continue
+                if len(phrase_text) < self.FUZZY_MIN_CHARS:
+                    continue
+                confidence = self.similarity(text, phrase_text, self.threshold)
+                if self.sounds_alike_ok(text, phrase_text):
+                    confidence = max(
+                        confidence,
+                        self.KEY_WEIGHT * self.similarity(key, phrase_key, self.threshold)
+                    )
+                if confidence >= self.threshold and confidence > best[2]:
+                    best = (action, phrase, confidence)
+
+        return best
+
+class RingBuffer:
+    """
+    Preallocated ring buffer of audio samples. The audio callback writes into it and the STT thread
+    reads out of it without allocating anything per block. If the reader falls behind, the oldest
+    samples are overwritten and counted as dropped.
+    """
+    def __init__(self, capacity, dtype=np.int16):
+        self.buf = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.read_count = 0
+        self.write_count = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        """
+        Copy samples (any object supporting the buffer protocol) into the buffer
+        """
+        samples = np.frombuffer(data, dtype=self.buf.dtype)
+        num = len(samples)
+        with self.cond:
+            if num > self.capacity:
+                self.write_count += num - self.capacity
+                samples = samples[-self.capacity:]
+                num = self.capacity
+            start = self.write_count % self.capacity
+            first = min(num, self.capacity - start)
+            self.buf[start:start + first] = samples[:first]
+            self.buf[:num - first] = samples[first:]
+            self.write_count += num
+            unread = self.write_count - self.read_count
+            if unread > self.capacity:
+                self.overflows += 1
+                self.dropped += unread - self.capacity
+                self.read_count = self.write_count - self.capacity
+            self.cond.notify()
+
+    def read_into(self, out, timeout=None):
+        """
+        Block until `len(out)` samples are available and copy them into `out`. Returns False if
+        the timeout expired first.
+        """
+        num = len(out)
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.write_count - self.read_count >= num, timeout):
+                return False
+            start = self.read_count % self.capacity
+            first = min(num, self.capacity - start)
+            out[:first] = self.buf[start:start + first]
+            out[first:] = self.buf[:num - first]
+            self.read_count += num
+        return True
+
+    def clear(self):
+        with self.cond:
+            self.read_count = self.write_count
+
+class SentenceSegmenter:
+    """
+    Splits a stream of text (e.g. tokens from the LLM) into sentences. Only newly added characters
+    are scanned, so the cost is linear in the length of the reply. A sentence ends at whitespace
+    after ".", "?", "!", ":", or "#" (or at a line break) that is followed by an uppercase letter or
+    digit. Abbreviations (e.g. "Dr."), initials, and list numbers (e.g. "1.") do not end a sentence.
+
+    If `first_chunk_budget` (seconds) is set and the first sentence has not ended within that time,
+    the first chunk is sent early: at the last comma/semicolon/dash after `first_chunk_min_words`
+    words, or after `first_chunk_max_words` words. After that, only whole sentences are returned.
+    """
+    TERMINATORS = ".?!:#"
+    CLAUSE_BREAKS = ",;\u2014"
+    ABBREVIATIONS = {
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "mt", "ft", "approx", "e.g", "i.e"
+    }
+
+    def __init__(self, first_chunk_budget=0.0, first_chunk_min_words=3, first_chunk_max_words=12):
+        self.first_chunk_budget = first_chunk_budget
+        self.first_chunk_min_words = first_chunk_min_words
+        self.first_chunk_max_words = first_chunk_max_words
+        self.buf = ""
+        self.pos = 0
+        self.boundary = None
+        self.emitted = False
+        self.start_time = None
+        self.words = 0
+        self.clause = None
+        self.last_space = None
+
+    def feed(self, text):
+        """
+        Add text and return a list of any sentences that are now complete
+        """
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        sentences = []
+        buf = self.buf + text
+        i = self.pos
+        while i < len(buf):
+            c = buf[i]
+
+            # In the whitespace after a possible boundary: the next character decides
+            if self.boundary is not None:
+                if c.isspace():
+                    i += 1
+                    continue
+                if c.isupper() or c.isdigit():
+                    sentence = self._clean(buf[:self.boundary])
+                    if sentence:
+                        sentences.append(sentence)
+                        self.emitted = True
+                    buf = buf[i:]
+                    i = 0
+                self.boundary = None
+
+            # Whitespace after a terminator or a line break is a possible boundary
+            elif c.isspace():
+                if c == "\n" or (i > 0 and buf[i - 1] in self.TERMINATORS):
+                    if self._ends_sentence(buf, i - 1):
+                        self.boundary = i
+
+                # Keep track of words and clauses in case we need to send the first chunk early
+                if not self.emitted and i > 0 and not buf[i - 1].isspace():
+                    self.words += 1
+                    self.last_space = (i, self.words)
+                    if buf[i - 1] in self.CLAUSE_BREAKS or buf[i - 1] == "-":
+                        self.clause = (i, self.words)
+                i += 1
+
+            else:
+                i += 1
+
+        # Send the start of a long first sentence if we have waited too long for it to end
+        if not sentences and not self.emitted and self.boundary is None:
+            split = self._early_split()
+            if split is not None:
+                sentences.append(self._clean(buf[:split]))
+                self.emitted = True
+                buf = buf[split:]
+                i -= split
+
+        self.buf = buf
+        self.pos = i
+
+        return sentences
+
+    def flush(self):
+        """
+        Return whatever text is left (as a list of zero or one sentences) and reset
+        """
+        sentence = self._clean(self.buf)
+        self.__init__(
+            self.first_chunk_budget,
+            self.first_chunk_min_words,
+            self.first_chunk_max_words
+        )
+
+        return [sentence] if sentence else []
+
+    def _early_split(self):
+        """
+        Return where to split off the first chunk early, or None to keep waiting
+        """
+        if self.first_chunk_budget <= 0:
+            return None
+        if time.monotonic() - self.start_time < self.first_chunk_budget:
+            return None
+        if self.clause is not None and self.clause[1] >= self.first_chunk_min_words:
+            return self.clause[0]
+        if self.last_space is not None and self.last_space[1] >= self.first_chunk_max_words:
+            return self.last_space[0]
+
+        return None
+
+    def _ends_sentence(self, buf, end):
+        """
+        Check whether the terminator at buf[end] ends the sentence
+        """
+        if end < 0:
+            return False
+        if buf[end] != ".":
+            return True
+
+        # Find the word before the period
+        start = end
+        while start > 0 and not buf[start - 1].isspace():
+            start -= 1
+        word = buf[start:end].lstrip("(\"'")
+        if word.lower() in self.ABBREVIATIONS:
+            return False
+
+        # Initials (e.g. "J. R. R. Tolkien")
+        if len(word) == 1 and word.isupper():
+            return False
+
+        # List numbers (e.g. "1. First item"), i.e. a number at the start of the sentence
+        if word.isdigit() and buf[:start].strip() == "":
+            return False
+
+        return True
+
+    @staticmethod
+    def _clean(sentence):
+        return sentence.replace("\n", " ").strip()
+
+class AudioCapture:
+    """
+    Microphone input that stays open for the life of the program. Backends write audio into a ring
+    buffer so that the wake phrase and query stages can read from the same stream without gaps.
+    """
+    def __init__(self, sample_rate, buffer_sec=10.0, block_sec=0.1):
+        self.sample_rate = sample_rate
+        self.device_info = {"name": type(self).__name__, "default_samplerate": sample_rate}
+        self.ring = RingBuffer(int(buffer_sec * self.sample_rate))
+
+        # Block handed to the recognizer. Reused for every read to avoid per-block allocations. Vosk
+        # only accepts bytes or cdata, so wrap the block in a cdata pointer once up front.
+        self.block = bytearray(int(block_sec * self.sample_rate) * np.dtype(np.int16).itemsize)
+        self.block_samples = np.frombuffer(self.block, dtype=np.int16)
+        self.block_cdata = FFI().from_buffer(self.block)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self):
+        """
+        Block until the next block of audio is available and return it. The returned buffer is
+        overwritten by the next call to read().
+        """
+        self.ring.read_into(self.block_samples)
+        return self.block_cdata
+
+    def clear(self):
+        """
+        Drop any audio captured while nobody was listening (e.g. during playback)
+        """
+        self.ring.clear()
+
+class SoundDeviceCapture(AudioCapture):
+    """
+    Records from a microphone with sounddevice (PortAudio)
+    """
+    def __init__(self, device=None, buffer_sec=10.0, block_sec=0.1):
+        if sd is None:
+            raise RuntimeError("sounddevice is not available (is PortAudio installed?)")
+        device_info = sd.query_devices(device, "input")
+        super().__init__(int(device_info["default_samplerate"]), buffer_sec, block_sec)
+        self.device_info = device_info
+        self.stream = sd.RawInputStream(
+            samplerate=self.sample_rate,
+            device=device,
+            dtype="int16",
+            channels=1,
+            callback=self.record_callback
+        )
+
+    def record_callback(self, in_data, frames, time_info, status):
+        """
+        Copy audio data into the ring buffer
+        """
+        if status:
+            print(status, file=sys.stderr)
+        self.ring.write(in_data)
+
+    def start(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+        self.stream.close()
+
+class WavFileCapture(AudioCapture):
+    """
+    Replays WAV files as if they were spoken into the microphone, so everything can be run without
+    hardware. Audio is fed into the ring buffer at the audio clock rate (scaled by `speed`), with
+    `gap_sec` of silence after each file and silence whenever nothing is queued.
+    """
+    def __init__(
+        self,
+        paths=(),
+        sample_rate=None,
+        gap_sec=1.5,
+        speed=1.0,
+        loop=False,
+        buffer_sec=10.0,
+        block_sec=0.1,
+        feed_sec=0.02
+    ):
+        if speed <= 0:
+            raise ValueError("Audio clock speed must be greater than 0")
+        files = [wavfile.read(path) for path in paths]
+        if sample_rate is None:
+            sample_rate = files[0][0] if files else 16000
+        super().__init__(sample_rate, buffer_sec, block_sec)
+        self.device_info["name"] = ", ".join(paths) or "WAV file"
+        self.gap = np.zeros(int(gap_sec * sample_rate), dtype=np.int16)
+        self.speed = speed
+        self.loop = loop
+        self.feed_samples = max(1, int(feed_sec * sample_rate))
+        self.clips = [self.convert(wav, rate) for rate, wav in files]
+        self.q = queue.Queue()
+        self.running = False
+        self.thread = None
+
+    def convert(self, wav, sample_rate):
+        """
+        Convert WAV file data to mono 16-bit samples at the capture sample rate
+        """
+        if wav.dtype.kind in "iu":
+            info = np.iinfo(wav.dtype)
+            wav = (wav.astype(np.float32) - (info.max + info.min + 1) / 2) / (info.max + 1)
+        wav = np.asarray(wav, dtype=np.float32)
+        if wav.ndim > 1:
+            wav = wav.mean(axis=1)
+        if sample_rate != self.sample_rate:
+            wav = resample(wav, sample_rate, self.sample_rate)
+        wav = np.clip(wav * np.iinfo(np.int16).max, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+
+        return wav.astype(np.int16)
+
+    def play(self, samples):
+        """
+        Queue 16-bit samples (at the capture sample rate) to be fed in after anything already queued
+        """
+        self.q.put(np.asarray(samples, dtype=np.int16))
+        if len(self.gap) > 0:
+            self.q.put(self.gap)
+
+    def replay(self):
+        """
+        Queue all of the WAV files, in order
+        """
+        for clip in self.clips:
+            self.play(clip)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.feed, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def feed(self):
+        """
+        Write queued audio (or silence) into the ring buffer, paced by the audio clock
+        """
+        silence = np.zeros(self.feed_samples, dtype=np.int16)
+        clip = None
+        offset = 0
+        next_time = time.monotonic()
+        while self.running:
+
+            # Get the next clip, starting over if looping
+            if clip is None:
+                if self.loop and self.q.empty():
+                    self.replay()
+                try:
+                    clip = self.q.get_nowait()
+                    offset = 0
+                except queue.Empty:
+                    pass
+
+            # Feed one block
+            if clip is not None:
+                block = clip[offset:offset + self.feed_samples]
+                offset += len(block)
+                if offset >= len(clip):
+                    clip = None
+            else:
+                block = silence
+            self.ring.write(block)
+            next_time += len(block) / self.sample_rate / self.speed
+            time.sleep(max(0.0, next_time - time.monotonic()))
+
+class EnergyVAD:
+    """
+    Cheap voice activity detector that sits in front of the recognizer, so Vosk only decodes
+    speech instead of burning CPU on silence. A block is speech if its RMS level is more than
+    `threshold_db` above an adaptive noise floor. Speech continues for `hangover_ms` after the last
+    loud block (so pauses between words do not cut it off), and the `preroll_ms` of audio before
+    the first loud block is kept so the start of the first word is not lost. The floor keeps
+    rising slowly during speech, so a segment cannot last forever if the noise itself gets louder
+    (e.g. a fan switching on).
+    """
+    SILENCE, START, SPEECH, END = range(4)
+    FLOOR_MIN_DB = -80.0        # Keep digital silence from pulling the floor down to -inf
+    FLOOR_ADAPT_SEC = 3.0       # Time constant for the noise floor to rise
+    FLOOR_SPEECH_ADAPT_SEC = 20.0   # Same, during speech (slow, so real speech is not cut off)
+    NOISE_SEGMENT_SEC = 3.0     # A segment this long without any words in it is just noise
+
+    def __init__(self, sample_rate, block_size, threshold_db=12.0, hangover_ms=600, preroll_ms=300):
+        block_sec = block_size / sample_rate
+        self.threshold_db = threshold_db
+        self.hangover_blocks = int(np.ceil(hangover_ms / 1000 / block_sec))
+        self.adapt = min(1.0, block_sec / self.FLOOR_ADAPT_SEC)
+        self.speech_adapt = min(1.0, block_sec / self.FLOOR_SPEECH_ADAPT_SEC)
+        self.floor = None
+        self.level = self.FLOOR_MIN_DB
+        self.buf = np.zeros(block_size, dtype=np.float32)
+        self.active = False
+        self.quiet_blocks = 0
+
+        # Pre-roll ring of blocks, allocated once (with cdata pointers, as Vosk needs them)
+        num_blocks = int(np.ceil(preroll_ms / 1000 / block_sec))
+        block_bytes = block_size * np.dtype(np.int16).itemsize
+        self.preroll = bytearray(num_blocks * block_bytes)
+        self.preroll_samples = np.frombuffer(self.preroll, dtype=np.int16).reshape(-1, block_size)
+        self.preroll_cdata = [
+            FFI().from_buffer(memoryview(self.preroll)[i * block_bytes:(i + 1) * block_bytes])
+            for i in range(num_blocks)
+        ]
+        self.preroll_count = 0
+
+    def reset(self):
+        """
+        Forget the current segment and pre-roll (but not the noise floor)
+        """
+        self.preroll_count = 0
+        self.active = False
+        self.quiet_blocks = 0
+
+    def rebase(self):
+        """
+        Take the current level as the noise floor and end the segment (e.g. when the recognizer
+        heard no words in it, so it was just louder noise)
+        """
+        self.floor = max(self.level, self.FLOOR_MIN_DB)
+        self.reset()
+
+    def measure(self, samples):
+        """
+        Return the RMS level of a block of 16-bit samples in dBFS
+        """
+        buf = self.buf[:len(samples)]
+        np.multiply(samples, 1.0 / 32768, out=buf)
+        power = np.dot(buf, buf) / max(len(buf), 1)
+
+        return 10 * np.log10(max(power, 1e-10))
+
+    def process(self, samples):
+        """
+        Classify the next block of 16-bit samples as SILENCE, START (of speech), SPEECH, or END (of
+        speech). Silent blocks are kept as pre-roll.
+        """
+        self.level = self.measure(samples)
+        if self.floor is None:
+            self.floor = max(self.level, self.FLOOR_MIN_DB)
+        loud = self.level > self.floor + self.threshold_db
+
+        # Silence: remember this block as pre-roll and let the noise floor follow the level
+        if not self.active:
+            if not loud:
+                if self.level < self.floor:
+                    self.floor = max(self.level, self.FLOOR_MIN_DB)
+                else:
+                    self.floor += self.adapt * (self.level - self.floor)
+                if len(self.preroll_samples):
+                    index = self.preroll_count % len(self.preroll_samples)
+                    self.preroll_samples[index] = samples
+                    self.preroll_count += 1
+                return self.SILENCE
+            self.active = True
+            self.quiet_blocks = 0
+            return self.START
+
+        # Speech: end the segment once it has been quiet for the hangover time
+        self.floor += self.speech_adapt * (self.level - self.floor)
+        if loud:
+            self.quiet_blocks = 0
+        else:
+            self.quiet_blocks += 1
+            if self.quiet_blocks > self.hangover_blocks:
+                self.active = False
+                return self.END
+
+        return self.SPEECH
+
+    def take_preroll(self):
+        """
+        Return the audio heard just before speech started (oldest first). The blocks are
+        overwritten by later calls to process().
+        """
+        num = min(self.preroll_count, len(self.preroll_cdata))
+        start = self.preroll_count - num
+        blocks = [
+            self.preroll_cdata[i % len(self.preroll_cdata)]
+            for i in range(start, self.preroll_count)
+        ]
+        self.preroll_count = 0
+
+        return blocks
+
+class EchoGate:
+    """
+    Crude echo suppression for listening while we are talking. The microphone picks up our own
+    speaker, so while something is playing, a block of audio only counts as the user talking if it
+    is louder than the expected echo by `margin_db`. How much of the speaker the microphone picks up
+    is learned from blocks that are just echo.
+    """
+    SILENCE_DB = -60.0          # Speaker quieter than this is not playing anything
+    ADAPT = 0.05                # How fast the echo level follows the microphone
+
+    def __init__(self, block_size, margin_db=10.0):
+        self.margin_db = margin_db
+        self.coupling_db = None
+        self.buf = np.zeros(block_size, dtype=np.float32)
+
+    def is_user(self, samples, speaker_power):
+        """
+        Return True if a block of 16-bit microphone samples is more than just our own echo
+        """
+        speaker_db = 10 * np.log10(max(speaker_power, 1e-10))
+        if speaker_db < self.SILENCE_DB:
+            return True
+        buf = self.buf[:len(samples)]
+        np.multiply(samples, 1.0 / 32768, out=buf)
+        mic_db = 10 * np.log10(max(np.dot(buf, buf) / max(len(buf), 1), 1e-10))
+
+        # Louder than our echo
+        echo_db = mic_db - speaker_db
+        if self.coupling_db is None:
+            self.coupling_db = echo_db
+        if echo_db > self.coupling_db + self.margin_db:
+            return True
+
+        # Just echo: learn how much of the speaker the microphone picks up
+        if echo_db < self.coupling_db:
+            self.coupling_db = echo_db
         else:
-            return [self.preamble] + list(self.queue)
+            self.coupling_db += self.ADAPT * (echo_db - self.coupling_db)
+
+        return False
+
+class AudioPlayer:
+    """
+    Speaker output that stays open for the life of the program. Chunks of audio are queued and
+    played back to back, so there are no gaps or clicks between sentences, and a sentence can
+    start playing before all of it has arrived. Backends call play_callback() to pull audio.
+    """
+    def __init__(self, sample_rate, blocksize=2048, num_levels=8):
+        self.sample_rate = sample_rate
+        self.blocksize = blocksize
+        self.q = queue.Queue()
+        self.chunk = None
+        self.offset = 0
+        self.active = False
+        self.active_since = None
+        self.underruns = 0
+        self.flush_requested = False
+        self.flushed = threading.Event()
+
+        # Power of the last few blocks played, for echo suppression
+        self.levels = np.zeros(num_levels)
+        self.level_count = 0
+
+    def play_callback(self, out_data, frames, time_info, status):
+        """
+        Fill the output buffer from the queued chunks, padding with silence if nothing is queued.
+        Returns the number of frames of queued audio (not padding) that were filled.
+        """
+        if status:
+            print(status, file=sys.stderr)
+        out = out_data[:, 0]
+
+        # Throw away everything queued (markers are still set, so nobody waits on them forever)
+        if self.flush_requested:
+            self.flush_requested = False
+            self.chunk = None
+            while True:
+                try:
+                    item = self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+            self.active = False
+            self.flushed.set()
+
+        filled = 0
+        while filled < frames:
+
+            # Get the next chunk. Markers are set when playback reaches them.
+            if self.chunk is None:
+                try:
+                    item = self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    self.active = False
+                    item.set()
+                    continue
+                self.chunk = item
+                self.offset = 0
+                if not self.active:
+                    self.active = True
+                    self.active_since = time.monotonic()
+
+            # Copy as much of the chunk as will fit
+            num = min(frames - filled, len(self.chunk) - self.offset)
+            out[filled:filled + num] = self.chunk[self.offset:self.offset + num]
+            filled += num
+            self.offset += num
+            if self.offset >= len(self.chunk):
+                self.chunk = None
+
+        # Ran out of audio in the middle of something (e.g. waiting on the next sentence)
+        if filled < frames:
+            out[filled:] = 0
+            if self.active:
+                self.underruns += 1
+
+        # Remember how loud this block was
+        self.levels[self.level_count % len(self.levels)] = np.dot(out, out) / max(frames, 1)
+        self.level_count += 1
+
+        return filled
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def write(self, wav):
+        """
+        Queue audio (float, at the output sample rate) to be played after anything already queued
+        """
+        wav = np.asarray(wav, dtype=np.float32)
+        if wav.ndim > 1:
+            wav = wav.mean(axis=1)
+        if len(wav) > 0:
+            self.q.put(np.ascontiguousarray(wav))
+
+    def mark(self):
+        """
+        Return an event that is set once everything queued so far has been played
+        """
+        event = threading.Event()
+        self.q.put(event)
+        return event
+
+    def flush(self, timeout=0.5):
+        """
+        Stop playing right away and throw away everything queued. Blocks until the next callback
+        has done it (or the timeout expires, e.g. if the stream is not running).
+        """
+        self.flushed.clear()
+        self.flush_requested = True
+        self.flushed.wait(timeout)
+
+    def level(self):
+        """
+        Return the loudest power (not dB) of the last few blocks played
+        """
+        return self.levels.max()
+
+class SoundDevicePlayer(AudioPlayer):
+    """
+    Plays to a speaker with sounddevice (PortAudio)
+    """
+    def __init__(self, sample_rate, device=None, blocksize=2048):
+        if sd is None:
+            raise RuntimeError("sounddevice is not available (is PortAudio installed?)")
+        super().__init__(sample_rate, blocksize)
+        self.stream = sd.OutputStream(
+            samplerate=sample_rate,
+            device=device,
+            channels=1,
+            dtype="float32",
+            blocksize=blocksize,
+            callback=self.play_callback
+        )
+
+    def start(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+        self.stream.close()
+
+class NullPlayer(AudioPlayer):
+    """
+    Consumes queued audio at the audio clock rate (scaled by `speed`) and throws it away, so the
+    timing of playback is the same as with a speaker
+    """
+    def __init__(self, sample_rate, speed=1.0, blocksize=2048):
+        if speed <= 0:
+            raise ValueError("Audio clock speed must be greater than 0")
+        super().__init__(sample_rate, blocksize)
+        self.speed = speed
+        self.played = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.consume, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def consume(self):
+        """
+        Pull one block at a time, paced by the audio clock
+        """
+        out = np.zeros((self.blocksize, 1), dtype=np.float32)
+        next_time = time.monotonic()
+        while self.running:
+            active = self.active
+            filled = self.play_callback(out, self.blocksize, None, None)
+            self.played += filled
+            if active or filled > 0:
+                self.output(out[:, 0])
+            next_time += self.blocksize / self.sample_rate / self.speed
+            time.sleep(max(0.0, next_time - time.monotonic()))
+
+    def output(self, block):
+        """
+        Called with each block of played audio (including silence in the middle of a reply)
+        """
+        pass
+
+class FilePlayer(NullPlayer):
+    """
+    Writes everything that would have been played to a 16-bit WAV file. Silence between replies is
+    left out.
+    """
+    def __init__(self, sample_rate, path, speed=1.0, blocksize=2048):
+        super().__init__(sample_rate, speed, blocksize)
+        self.path = path
+        self.file = None
+
+    def start(self):
+        self.file = wave.open(self.path, "wb")
+        self.file.setnchannels(1)
+        self.file.setsampwidth(np.dtype(np.int16).itemsize)
+        self.file.setframerate(self.sample_rate)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def output(self, block):
+        samples = np.clip(block, -1.0, 1.0) * np.iinfo(np.int16).max
+        self.file.writeframes(samples.astype("<i2").tobytes())
+
+class Interrupt:
+    """
+    Lets the chat thread cut a reply short (barge-in). While interrupted, the TTS and sound threads
+    throw away everything they get, including audio from sentences that are still being
+    synthesized, until a FLUSH marker sent after the end of the reply has made it all the way
+    through. The lock makes sure the sound thread cannot play anything, or report that the reply is
+    done, once the chat thread has decided to interrupt it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def begin(self, sound_semaphore):
+        """
+        Start interrupting the current reply. Returns False if the reply has already finished
+        playing (so there is nothing to interrupt).
+        """
+        with self.lock:
+            if sound_semaphore.acquire(blocking=False):
+                return False
+            self.event.set()
+            return True
+
+    def end(self):
+        self.event.clear()
+
+class Resampler:
+    """
+    Rational polyphase resampler. Audio can be fed one chunk at a time: the last few input samples
+    and the position of the next output sample are carried between chunks, so the output is the
+    same as resampling the whole thing at once. The filter is designed once per rate pair and
+    quality setting.
+    """
+
+    # Taps per phase, Kaiser window beta, and cutoff (as a fraction of the lower Nyquist rate)
+    QUALITY = {
+        "fast": (8, 5.0, 0.85),
+        "medium": (16, 8.0, 0.9),
+        "high": (32, 10.0, 0.95),
+    }
+
+    def __init__(self, in_rate, out_rate, quality="medium"):
+        if quality not in self.QUALITY:
+            raise ValueError(f"Unknown resample quality: {quality}")
+        divisor = gcd(int(in_rate), int(out_rate))
+        self.up = int(out_rate) // divisor
+        self.down = int(in_rate) // divisor
+        self.phases, self.delay = design_polyphase_filter(self.up, self.down, quality)
+        self.num_taps = self.phases.shape[1]
+        self.history = np.zeros(self.num_taps - 1, dtype=np.float32)
+        self.next_index = self.delay
+        self.in_count = 0
+        self.out_count = 0
+
+    def process(self, chunk):
+        """
+        Resample the next chunk of audio and return as many output samples as are ready
+        """
+        chunk = np.asarray(chunk, dtype=np.float32)
+        buf = np.concatenate((self.history, chunk))
+        end = len(chunk) * self.up
+
+        # Indexes (in the upsampled signal) of the output samples we have enough input for
+        num = (end - self.next_index - 1) // self.down + 1 if self.next_index < end else 0
+        indexes = self.next_index + np.arange(num) * self.down
+
+        # Each output sample is a dot product of the latest inputs with one phase of the filter
+        windows = np.lib.stride_tricks.sliding_window_view(buf, self.num_taps)
+        out = np.einsum(
+            "ij,ij->i",
+            windows[indexes // self.up],
+            self.phases[indexes % self.up]
+        )
+
+        # Carry state over to the next chunk
+        self.next_index += num * self.down - end
+        self.history = buf[len(buf) - (self.num_taps - 1):]
+        self.in_count += len(chunk)
+        self.out_count += num
+
+        return out
+
+    def flush(self):
+        """
+        Return the last output samples, which need input from beyond the end of the audio
+        """
+        total = -(-self.in_count * self.up // self.down)
+        remaining = total - self.out_count
+        out = self.process(np.zeros(self.delay // self.up + 2, dtype=np.float32))
+        return out[:max(0, remaining)]
+
+class TTSCache:
+    """
+    Cache of synthesized audio (float32 at the output sample rate), keyed on everything that changes
+    how the audio sounds. Recently used entries are kept in memory, up to `max_entries` entries and
+    `max_bytes` of audio (0 for no size limit). Short phrases can also be saved to disk so they
+    survive restarts.
+    """
+    def __init__(self, max_entries=64, cache_dir="", disk_max_chars=80, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.cache_dir = cache_dir
+        self.disk_max_chars = disk_max_chars
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(text, voice, volume, sample_rate):
+        data = json.dumps([text.strip(), voice, volume, sample_rate])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Return cached audio or None. The returned array must not be modified.
+        """
+
+        # Check memory first
+        with self.lock:
+            wav = self.pinned.get(key)
+            if wav is None:
+                wav = self.entries.get(key)
+            if wav is not None:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                self.hits += 1
+                return wav
+
+        # Then disk
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.npy")
+            try:
+                wav = np.load(path)
+            except FileNotFoundError:
+                wav = None
+
+            # Delete files that cannot be read (e.g. truncated), so they get written again
+            except (OSError, ValueError, EOFError) as e:
+                print(f"Bad TTS cache file {path}: {e}", file=sys.stderr)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                wav = None
+            if wav is not None:
+                self._remember(key, wav)
+                with self.lock:
+                    self.disk_hits += 1
+                return wav
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, wav, text=""):
+        """
+        Add audio to the cache. Text that is short enough is also saved to disk.
+        """
+        wav = np.asarray(wav, dtype=np.float32)
+        self._remember(key, wav)
+        if self.cache_dir and len(text) <= self.disk_max_chars:
+            path = os.path.join(self.cache_dir, f"{key}.npy")
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, wav)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Could not write TTS cache file: {e}", file=sys.stderr)
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def pin(self, key, wav):
+        """
+        Keep audio in memory for good (e.g. canned responses), regardless of the LRU size
+        """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.pinned[key] = np.asarray(wav, dtype=np.float32)
+
+    def _remember(self, key, wav):
+        if self.max_entries <= 0 or 0 < self.max_bytes < wav.nbytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = wav
+            self.nbytes += wav.nbytes
+            while len(self.entries) > self.max_entries or \
+                    0 < self.max_bytes < self.nbytes:
+                self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / total if total else 0.0
+        return f"TTS cache: {self.hits} memory hits, {self.disk_hits} disk hits, " \
+            f"{self.misses} misses ({round(100 * hit_rate)}% hit rate)"
+
+class TTSClient:
+    """
+    HTTP client for the Piper TTS server. Connections are kept open between sentences, and requests
+    that fail for transient reasons are retried with exponential backoff.
+    """
+    def __init__(
+        self,
+        url,
+        connect_timeout=3.0,
+        read_timeout=30.0,
+        retries=3,
+        backoff=0.5,
+        pool_size=10
+    ):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504)
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def ping(self):
+        """
+        Check that the server is up and can synthesize speech. Raises requests.RequestException
+        if not.
+        """
+        resp = self.session.get(self.url, params={"text": "Hi."}, timeout=self.timeout)
+        resp.raise_for_status()
+
+    def synthesize(self, text):
+        """
+        Send text to the TTS server and return (sample_rate, wav). Returns None if the server
+        could not produce audio, so a single bad sentence does not take down the TTS thread.
+        """
+        try:
+            resp = self.session.get(self.url, params={"text": text}, timeout=self.timeout)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Failed to get response from TTS server: {e}", file=sys.stderr)
+            return None
+
+        return wavfile.read(io.BytesIO(resp.content))
+
+    def synthesize_stream(self, text, chunk_size=4096):
+        """
+        Send text to the TTS server and yield (sample_rate, samples) as the response arrives. Raises
+        requests.RequestException if the server fails, so partial audio can be told apart from a
+        complete sentence.
+        """
+        with self.session.get(
+            self.url,
+            params={"text": text},
+            timeout=self.timeout,
+            stream=True
+        ) as resp:
+            resp.raise_for_status()
+            buf = b""
+            fmt = None
+            for data in resp.iter_content(chunk_size=chunk_size):
+                buf += data
+
+                # Wait for the whole header before returning any audio
+                if fmt is None:
+                    fmt = parse_wav_header(buf)
+                    if fmt is None:
+                        continue
+                    buf = buf[fmt["data_offset"]:]
+
+                # Only return whole frames, keeping any partial frame for next time
+                frame_size = fmt["channels"] * 2
+                num = len(buf) - len(buf) % frame_size
+                if num > 0:
+                    samples = np.frombuffer(buf[:num], dtype=np.int16)
+                    buf = buf[num:]
+                    if fmt["channels"] > 1:
+                        samples = samples.reshape(-1, fmt["channels"]).mean(axis=1)
+                    yield fmt["sample_rate"], samples
+
+class LatencyTracer:
+    """
+    Records how long each stage of a voice interaction takes. Times are in milliseconds from the
+    (estimated) end of the user's speech. Marks record the first time something happens (e.g. the
+    first audio out), while spans record durations that can happen many times per interaction
+    (e.g. one TTS request per sentence). Each interaction is written to a JSON lines file, and
+    percentiles for each stage can be printed on shutdown.
+    """
+    def __init__(self, path="", max_history=1000):
+        self.path = path
+        self.max_history = max_history
+        self.lock = threading.Lock()
+        self.current = None
+        self.history = {}
+        self.count = 0
+
+    def begin(self, start=None, **fields):
+        """
+        Start tracing an interaction. `start` is a time.monotonic() timestamp (default: now).
+        """
+        with self.lock:
+            self.current = {
+                "time": time.time(),
+                "start": time.monotonic() if start is None else start,
+                "fields": fields,
+                "marks": {},
+                "spans": {},
+            }
+
+    def set(self, **fields):
+        with self.lock:
+            if self.current is not None:
+                self.current["fields"].update(fields)
+
+    def mark(self, name, timestamp=None):
+        """
+        Record the first time `name` happens in this interaction
+        """
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        with self.lock:
+            if self.current is not None and name not in self.current["marks"]:
+                self.current["marks"][name] = 1000 * (timestamp - self.current["start"])
+
+    def span(self, name, duration):
+        """
+        Record how long (in seconds) one occurrence of `name` took
+        """
+        with self.lock:
+            if self.current is not None:
+                self.current["spans"].setdefault(name, []).append(1000 * duration)
+
+    def discard(self):
+        with self.lock:
+            self.current = None
+
+    def end(self):
+        """
+        Finish the interaction, save it, and return the record
+        """
+        self.mark("total")
+        with self.lock:
+            trace = self.current
+            self.current = None
+        if trace is None:
+            return None
+
+        # Build the record
+        record = {"time": trace["time"], **trace["fields"]}
+        record.update({name: round(ms, 1) for name, ms in trace["marks"].items()})
+        for name, durations in trace["spans"].items():
+            record[name] = [round(ms, 1) for ms in durations]
+
+        # Keep recent values of each stage for the summary
+        with self.lock:
+            self.count += 1
+            stages = list(trace["marks"].items())
+            stages += [(name, ms) for name, durations in trace["spans"].items() for ms in durations]
+            for name, ms in stages:
+                self.history.setdefault(name, deque(maxlen=self.max_history)).append(ms)
+
+        # Append it to the trace file
+        if self.path:
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"Could not write trace: {e}", file=sys.stderr)
+
+        return record
+
+    def summary(self):
+        """
+        Return a table of p50/p95/p99 (in ms) for each stage
+        """
+        with self.lock:
+            history = {name: list(values) for name, values in self.history.items()}
+        lines = [f"Latency over {self.count} interactions (ms):"]
+        lines.append(f"  {'stage':<24}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for name, values in history.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            lines.append(f"  {name:<24}{len(values):>7}{p50:>9.0f}{p95:>9.0f}{p99:>9.0f}")
+
+        return "\n".join(lines)
+
+class Startup:
+    """
+    Runs the startup steps (loading models, warming up servers, etc.) at the same time and times
+    each one. Steps that can fail for transient reasons (e.g. a server that is still booting) are
+    retried until they succeed, so nothing is announced as ready until everything is warm.
+    """
+    def __init__(self, retry_sec=5.0):
+        self.retry_sec = retry_sec
+        self.steps = []
+        self.timings = {}
+
+    def add(self, name, func, retry=False):
+        """
+        Add a step. The result of func() is returned by run() under the given name. If `retry` is
+        set and func() fails with a transient error (see is_transient()), it is called again after
+        a delay. Any other error is raised.
+        """
+        self.steps.append((name, func, retry))
+
+    def run(self):
+        """
+        Run all of the steps and return their results (raises if a step without retries fails)
+        """
+        with ThreadPoolExecutor(
+            max_workers=max(len(self.steps), 1),
+            thread_name_prefix="startup"
+        ) as executor:
+            jobs = {
+                name: executor.submit(self.run_step, name, func, retry)
+                for name, func, retry in self.steps
+            }
+            return {name: job.result() for name, job in jobs.items()}
+
+    def run_step(self, name, func, retry):
+        timestamp = time.monotonic()
+        while True:
+            try:
+                result = func()
+                break
+            except Exception as e:
+                if not retry or not is_transient(e):
+                    raise
+                print(
+                    f"Startup: {name} not ready ({e}). Retrying in {self.retry_sec} sec.",
+                    file=sys.stderr
+                )
+                time.sleep(self.retry_sec)
+        self.timings[name] = time.monotonic() - timestamp
+
+        return result
+
+    def report(self):
+        """
+        Return the time taken by each step as a string
+        """
+        return ", ".join(f"{name} {round(sec, 1)} sec" for name, sec in self.timings.items())
+
+class ChatStream:
+    """
+    Streaming reply from the chat server. Chunks are read by a background thread, so the reply can
+    time out if the server stalls, and close() can abort it from another thread. Closing shuts
+    down the connection right away, which also makes Ollama stop generating. Connections come from
+    a pool (`transport`) shared by all streams.
+    """
+    def __init__(
+        self,
+        host,
+        transport,
+        model,
+        messages,
+        options,
+        keep_alive=None,
+        first_token_timeout=0,
+        token_timeout=0
+    ):
+        self.first_token_timeout = first_token_timeout
+        self.token_timeout = token_timeout
+        self.q = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.sock = None
+
+        # The client is only a thin wrapper around the shared pool, with a hook that finds out which
+        # connection this reply uses, so closing it does not affect any other request
+        self.client = ollama.Client(
+            host=host,
+            transport=transport,
+            event_hooks={"response": [self.on_response]}
+        )
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(model, messages, options, keep_alive),
+            daemon=True
+        )
+        self.thread.start()
+
+    def on_response(self, response):
+        """
+        Remember the socket of the response, so the read can be interrupted. Error responses are
+        read in full and their connection goes back to the pool straight away, so they are left
+        alone.
+        """
+        if response.status_code >= 400:
+            return
+        with self.lock:
+            self.sock = response.extensions["network_stream"].get_extra_info("socket")
+            if self.closed:
+                self.shutdown()
+
+    def run(self, model, messages, options, keep_alive):
+        """
+        Send the request and buffer the reply
+        """
+        stream = self.client.chat(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=keep_alive,
+            stream=True
+        )
+        try:
+            for chunk in stream:
+
+                # The client puts the connection back in the pool as soon as it reads past the last
+                # chunk, where another request may pick it up, so close() must stop touching it now
+                if chunk.get("done"):
+                    with self.lock:
+                        self.sock = None
+                if self.closed:
+                    break
+                self.q.put(chunk)
+        except Exception as e:
+            if not self.closed:
+                self.q.put(e)
+
+        # Release the connection (back to the pool, unless it was shut down)
+        finally:
+            stream.close()
+            with self.lock:
+                self.sock = None
+        self.q.put(None)
+
+    def shutdown(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        Stop reading the reply and drop the connection (safe to call from any thread)
+        """
+        with self.lock:
+            self.closed = True
+            self.shutdown()
+        self.q.put(None)
+
+    def __iter__(self):
+        """
+        Yield chunks of the reply. Raises TimeoutError if the server takes too long to send one.
+        """
+        timeout = self.first_token_timeout
+        while not self.closed:
+            try:
+                item = self.q.get(timeout=timeout if timeout > 0 else None)
+            except queue.Empty:
+                self.close()
+                raise TimeoutError(f"No reply from chat server in {timeout} sec")
+            if item is None or self.closed:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            timeout = self.token_timeout
+
+class ChatBackend:
+    """
+    Wraps the Ollama client with the settings used for every request: model options (e.g. reply
+    length limit), how long the model stays loaded, and timeouts. Optionally keeps the model loaded
+    by pinging the server whenever it has been idle for a while.
+    """
+    COLD_LOAD_SEC = 0.5         # Loading for longer than this means the model was not in memory
+
+    def __init__(
+        self,
+        host,
+        model,
+        options=None,
+        keep_alive=None,
+        first_token_timeout=0,
+        token_timeout=0
+    ):
+        self.host = host
+        self.model = model
+        self.options = dict(options or {})
+        self.keep_alive = keep_alive
+        self.first_token_timeout = first_token_timeout
+        self.token_timeout = token_timeout
+
+        # One connection pool for all requests, so each reply does not have to set up a new client
+        # and connection
+        self.transport = httpx.HTTPTransport()
+        self.client = ollama.Client(host=host, transport=self.transport)
+        self.last_request = time.monotonic()
+        self.keep_warm_thread = None
+
+    def load(self):
+        """
+        Load the model into memory (an empty prompt only loads the model)
+        """
+        self.last_request = time.monotonic()
+        self.client.generate(
+            model=self.model,
+            prompt="",
+            options=self.options,
+            keep_alive=self.keep_alive
+        )
+
+    def chat(self, messages, max_tokens=None):
+        """
+        Start streaming a reply to the messages (optionally with a different reply length limit).
+        Returns a ChatStream.
+        """
+        self.last_request = time.monotonic()
+        options = dict(self.options)
+        if max_tokens is not None:
+            options.pop("num_predict", None)
+            if max_tokens > 0:
+                options["num_predict"] = max_tokens
+        return ChatStream(
+            self.host,
+            self.transport,
+            self.model,
+            messages,
+            options,
+            self.keep_alive,
+            self.first_token_timeout,
+            self.token_timeout
+        )
+
+    def start_keep_warm(self, interval):
+        """
+        Start a thread that loads the model again whenever no request has been sent for `interval`
+        seconds, so the server never unloads it between conversations
+        """
+        self.keep_warm_thread = threading.Thread(
+            target=self.keep_warm,
+            args=(interval,),
+            daemon=True
+        )
+        self.keep_warm_thread.start()
+
+    def keep_warm(self, interval):
+        while True:
+            time.sleep(max(self.last_request + interval - time.monotonic(), 0.0))
+            if time.monotonic() - self.last_request < interval:
+                continue
+            try:
+                timestamp = time.monotonic()
+                self.load()
+                if DEBUG:
+                    print(f"Kept chat model warm ({round(time.monotonic() - timestamp, 1)} sec)")
+            except Exception as e:
+                print(f"Could not keep chat model warm: {e}", file=sys.stderr)
+
+class Pipeline:
+    """
+    Starts the chat, TTS, and sound threads around an audio capture and player, and shuts them down
+    again. Used by main() and by the benchmarks in test/.
+    """
+    def __init__(self, capture, player, tracer, servo_notify=None):
+        self.capture = capture
+        self.player = player
+        self.tracer = tracer
+        self.servo_notify = servo_notify
+        self.tts_q = queue.Queue()
+        self.interrupt = Interrupt()
+        self.ready = threading.Event()
+        self.tts_client = None
+        self.tts_cache = None
+        self.tts_executor = None
+        self.threads = []
+        self.chat_thread = None
+
+    def start(self):
+
+        # Semaphore used to notify main thread when TTS is done playing
+        sound_semaphore = threading.BoundedSemaphore(1)
+        sound_semaphore.acquire()
+
+        # Start TTS and sound threads
+        if TTS_ENABLE:
+            order_q = queue.Queue()
+            sound_q = queue.Queue()
+            self.tts_client = TTSClient(
+                PIPER_URL,
+                connect_timeout=PIPER_CONNECT_TIMEOUT,
+                read_timeout=PIPER_READ_TIMEOUT,
+                retries=PIPER_RETRIES,
+                backoff=PIPER_RETRY_BACKOFF,
+                pool_size=TTS_MAX_IN_FLIGHT
+            )
+            self.tts_cache = TTSCache(
+                max_entries=TTS_CACHE_SIZE,
+                cache_dir=TTS_CACHE_DIR,
+                disk_max_chars=TTS_CACHE_DISK_MAX_CHARS,
+                max_bytes=int(TTS_CACHE_MAX_MB * 1024 * 1024)
+            )
+            self.tts_executor = ThreadPoolExecutor(
+                max_workers=TTS_MAX_IN_FLIGHT,
+                thread_name_prefix="tts"
+            )
+            self.threads = [
+                threading.Thread(
+                    target=start_tts_thread,
+                    args=(
+                        self.tts_q,
+                        order_q,
+                        self.tts_client,
+                        self.tts_cache,
+                        self.tracer,
+                        self.interrupt,
+                        self.tts_executor,
+                        threading.BoundedSemaphore(TTS_MAX_IN_FLIGHT)
+                    )
+                ),
+                threading.Thread(
+                    target=start_reorder_thread,
+                    args=(order_q, sound_q)
+                ),
+                threading.Thread(
+                    target=start_sound_thread,
+                    args=(
+                        sound_q,
+                        sound_semaphore,
+                        self.interrupt,
+                        self.servo_notify,
+                        self.player,
+                        self.tracer
+                    )
+                ),
+            ]
+            for thread in self.threads:
+                thread.start()
+
+        # Start STT and chat thread (daemon, as it spends most of its time blocked on the mic)
+        self.chat_thread = threading.Thread(
+            target=start_chat_thread,
+            args=(
+                self.capture,
+                self.player,
+                self.tts_q,
+                sound_semaphore,
+                self.interrupt,
+                self.tts_client,
+                self.tts_cache,
+                self.tracer,
+                self.ready
+            ),
+            daemon=True
+        )
+        self.chat_thread.start()
+
+    def wait_until_ready(self):
+        """
+        Block until the chat thread has loaded everything and is listening
+        """
+        while not self.ready.wait(timeout=1.0):
+            if not self.chat_thread.is_alive():
+                raise RuntimeError("Chat thread failed to start")
+
+    def stop(self):
+        """
+        Tell the TTS and sound threads to exit once they finish what they are doing
+        """
+        self.tts_q.put(SHUTDOWN)
+        for thread in self.threads:
+            thread.join(timeout=5.0)
+        if self.tts_executor is not None:
+            self.tts_executor.shutdown(wait=False)
+        if DEBUG and self.tts_cache is not None:
+            print(self.tts_cache.stats())
 
 #---------------------------------------------------------------------------------------------------
 # Functions
 
+def is_transient(e):
+    """
+    Return True if an error from a server (or a download) is likely to go away by itself, e.g. the
+    server is still starting up or is overloaded. Errors like a misspelled model name (4xx) are not.
+    """
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code >= 500
+    if isinstance(e, requests.HTTPError):
+        return e.response is None or e.response.status_code >= 500
+    return isinstance(e, (OSError, httpx.TransportError))
+
 def parse_config_list(list_as_string):
     return [element.strip().strip('"') for element in list_as_string.strip().split(',')]
 
-def record_callback(in_data, frames, time, status, q):
+@functools.lru_cache(maxsize=None)
+def design_polyphase_filter(up, down, quality):
     """
-    Fill global input queue with audio data
+    Design a low-pass filter for resampling by up/down and split it into `up` phases. Each phase
+    is reversed so it can be applied directly to a window of input samples. Returns the phases and
+    the filter delay (in upsampled samples).
     """
-    if status:
-        print(status, file=sys.stderr)
-    q.put(bytes(in_data))
+    taps_per_phase, beta, rolloff = Resampler.QUALITY[quality]
+
+    # Use an odd number of taps so the delay is a whole number of samples
+    num_taps = taps_per_phase * up - 1
+    taps = signal.firwin(num_taps, rolloff / max(up, down), window=("kaiser", beta)) * up
+    taps = np.append(taps, 0.0)
+    phases = taps.reshape(taps_per_phase, up).T[:, ::-1]
 
-def wait_for_stt(q, recognizer):
+    return np.ascontiguousarray(phases, dtype=np.float32), (num_taps - 1) // 2
+
+def resample(wav, in_rate, out_rate, block_size=8192):
     """
-    Wait for STT to hear something and return the text
+    Resample a whole array of (mono) audio
     """
+    resampler = Resampler(in_rate, out_rate, RESAMPLE_QUALITY)
+    out = [resampler.process(wav[i:i + block_size]) for i in range(0, len(wav), block_size)]
+    out.append(resampler.flush())
 
-    # Listen for wake word/phrase
-    with sd.RawInputStream(
-        dtype="int16",
-        channels=1,
-        callback=lambda in_data, frames, time, status: record_callback(in_data, frames, time, status, q)
-    ):
-        if DEBUG:
-            print("Listening...")
+    return np.concatenate(out)
 
-        # Perform keyword spotting
-        while True:
-            data = q.get()
-            if recognizer.AcceptWaveform(data):
+def parse_wav_header(buf):
+    """
+    Parse the header of a 16-bit PCM WAV file. Returns the format (including the offset of the
+    audio data) or None if more bytes are needed.
+    """
+    if len(buf) < 12:
+        return None
+    if buf[0:4] != b"RIFF" or buf[8:12] != b"WAVE":
+        raise ValueError("Not a WAV file")
+
+    # Walk the chunks until we find the audio data
+    fmt = {}
+    offset = 12
+    while len(buf) >= offset + 8:
+        chunk_id = buf[offset:offset + 4]
+        chunk_size = struct.unpack("<I", buf[offset + 4:offset + 8])[0]
+        if chunk_id == b"data":
+            if not fmt:
+                raise ValueError("WAV data chunk found before fmt chunk")
+            fmt["data_offset"] = offset + 8
+            return fmt
+        if len(buf) < offset + 8 + chunk_size:
+            return None
+        if chunk_id == b"fmt ":
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack(
+                "<HHIIHH",
+                buf[offset + 8:offset + 24]
+            )
+            if audio_format != 1 or bits != 16:
+                raise ValueError(f"Unsupported WAV format: {audio_format}, {bits} bits")
+            fmt = {"channels": channels, "sample_rate": sample_rate}
+        offset += 8 + chunk_size + chunk_size % 2
 
-                # Perform speech-to-text (STT)
-                result = recognizer.Result()
-                result_dict = json.loads(result)
-                result_text = result_dict.get("text", "")
+    return None
 
-                return result_text
+def create_capture():
+    """
+    Open the audio input backend chosen in the config
+    """
+    if AUDIO_INPUT_BACKEND == "sounddevice":
+        return SoundDeviceCapture(AUDIO_INPUT_INDEX, buffer_sec=AUDIO_INPUT_BUFFER_SEC)
+    elif AUDIO_INPUT_BACKEND == "wav":
+        capture = WavFileCapture(
+            AUDIO_INPUT_WAV_PATHS,
+            gap_sec=AUDIO_INPUT_WAV_GAP_SEC,
+            speed=AUDIO_CLOCK_SPEED,
+            loop=AUDIO_INPUT_WAV_LOOP,
+            buffer_sec=AUDIO_INPUT_BUFFER_SEC
+        )
+        capture.replay()
+        return capture
+    raise ValueError(f"Unknown audio input backend: {AUDIO_INPUT_BACKEND}")
+
+def create_player():
+    """
+    Open the audio output backend chosen in the config
+    """
+    if AUDIO_OUTPUT_BACKEND == "sounddevice":
+        return SoundDevicePlayer(AUDIO_OUTPUT_SAMPLE_RATE, AUDIO_OUTPUT_INDEX)
+    elif AUDIO_OUTPUT_BACKEND == "null":
+        return NullPlayer(AUDIO_OUTPUT_SAMPLE_RATE, speed=AUDIO_CLOCK_SPEED)
+    elif AUDIO_OUTPUT_BACKEND == "file":
+        return FilePlayer(AUDIO_OUTPUT_SAMPLE_RATE, AUDIO_OUTPUT_FILE_PATH, speed=AUDIO_CLOCK_SPEED)
+    raise ValueError(f"Unknown audio output backend: {AUDIO_OUTPUT_BACKEND}")
+
+def wait_for_stt(
+    capture,
+    recognizer,
+    tracer=None,
+    vad=None,
+    timeout=None,
+    matcher=None,
+    on_stable=None,
+    echo_gate=None,
+    player=None
+):
+    """
+    Wait for STT to hear something and return the text. If a tracer is given, a new interaction
+    is started, timed from when the partial result last changed (i.e. roughly the end of speech).
+    If a VAD is given, only speech (plus pre-roll) is sent to the recognizer, and an empty string
+    is returned if nobody starts talking within `timeout` seconds. If a phrase matcher is given, the
+    first phrase heard is returned right away, without waiting for the speaker to finish.
+
+    Rather than waiting for Vosk to decide the speaker is done, the utterance is ended once the
+    partial result has not changed for STT_ENDPOINT_SILENCE_MS or it has gone on for longer than
+    STT_MAX_UTTERANCE_SEC (both measured in audio time). on_stable(text) is called once the
+    partial result has not changed for STT_SPECULATIVE_MS, which is a good guess at the final text.
+    If an echo gate is given, audio that is just the player's output (e.g. the notification sound)
+    is ignored.
+    """
+    if DEBUG:
+        print("Listening...")
+    dropped = capture.ring.dropped
+    partial_text = ""
+    speech_end = time.monotonic()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    block_sec = len(capture.block_samples) / capture.sample_rate
+    audio_time = 0.0
+    changed_at = 0.0
+    utterance_start = 0.0
+    stable_sent = False
+    segment_start = 0.0
+    if vad is not None:
+        vad.reset()
+
+    # Feed audio from the always-open capture stream to the recognizer
+    while True:
+        data = capture.read()
+        audio_time += block_sec
+        finalize = False
+
+        # Give up if nobody has started talking in time (even if it is noisy)
+        if deadline is not None and not partial_text and time.monotonic() > deadline:
+            return ""
+
+        # Keep our own sounds away from the VAD and the recognizer
+        if echo_gate is not None and \
+                not echo_gate.is_user(capture.block_samples, player.level()):
+            continue
+        if vad is not None:
+            state = vad.process(capture.block_samples)
+
+            # Skip silence (Vosk would otherwise give up on its own after a while)
+            if state == EnergyVAD.SILENCE:
+                continue
+
+            # Catch the start of the first word
+            elif state == EnergyVAD.START:
+                segment_start = audio_time
+                for block in vad.take_preroll():
+                    recognizer.AcceptWaveform(block)
+
+            # If the recognizer has not heard any words for a while, the noise just got louder
+            elif state == EnergyVAD.SPEECH and \
+                    audio_time - segment_start > EnergyVAD.NOISE_SEGMENT_SEC and \
+                    not PhraseMatcher.normalize(partial_text):
+                if DEBUG:
+                    print(f"Noise floor raised to {round(vad.level)} dB")
+                vad.rebase()
+                recognizer.Reset()
+                partial_text = ""
+                continue
+            finalize = state == EnergyVAD.END
+        accepted = recognizer.AcceptWaveform(data)
+
+        # Keep track of when the partial result last changed (i.e. the user stopped talking),
+        # look for phrases mid-utterance, and decide if the user is done
+        if not accepted and not finalize:
+            text = json.loads(recognizer.PartialResult()).get("partial", "")
+            if text != partial_text:
+                if not partial_text:
+                    utterance_start = audio_time
+                partial_text = text
+                speech_end = time.monotonic()
+                changed_at = audio_time
+                stable_sent = False
+                if matcher is not None:
+                    action, phrase, confidence = matcher.match(text, suffix=True)
+                    if action is not None:
+                        if tracer is not None:
+                            tracer.begin(start=speech_end)
+                            tracer.mark("stt_final")
+                        return phrase
+            elif text:
+                stable_sec = audio_time - changed_at
+                if on_stable is not None and not stable_sent and \
+                        stable_sec >= STT_SPECULATIVE_MS / 1000:
+                    on_stable(text)
+                    stable_sent = True
+                if 0 < STT_ENDPOINT_SILENCE_MS <= 1000 * stable_sec:
+                    finalize = True
+                elif 0 < STT_MAX_UTTERANCE_SEC <= audio_time - utterance_start:
+                    finalize = True
+        if not accepted and not finalize:
+            continue
+
+        # Perform speech-to-text (STT)
+        result = recognizer.Result() if accepted else recognizer.FinalResult()
+        result_dict = json.loads(result)
+        result_text = result_dict.get("text", "")
+        if matcher is not None:
+            action, phrase, confidence = matcher.match(result_text, suffix=True)
+            if action is not None:
+                result_text = phrase
+
+        # Just noise, so keep listening
+        if result_text == "" and (vad is not None or not accepted):
+            partial_text = ""
+            continue
+
+        # Let the user know if the recognizer could not keep up with the microphone
+        if DEBUG and capture.ring.dropped > dropped:
+            print(f"Input overflow: dropped {capture.ring.dropped - dropped} samples")
+
+        # Time from the end of speech to the final result
+        if tracer is not None:
+            tracer.begin(start=speech_end)
+            tracer.mark("stt_final")
+
+        return result_text
+
+def wait_for_barge_in(capture, recognizer, matcher, echo_gate, player, done):
+    """
+    Listen for the user talking over a reply until done() returns True. Returns (action, phrase)
+    if they said one of the matcher's phrases, or None if the reply finished first. Our own speech
+    is kept away from the recognizer by the echo gate.
+    """
+    recognizer.Reset()
+    while not done():
+        data = capture.read()
+        if not echo_gate.is_user(capture.block_samples, player.level()):
+            continue
+        if recognizer.AcceptWaveform(data):
+            text = json.loads(recognizer.Result()).get("text", "")
+        else:
+            text = json.loads(recognizer.PartialResult()).get("partial", "")
+        action, phrase, confidence = matcher.match(text, suffix=True)
+        if action is not None:
+            return action, phrase
+
+    return None
+
+def split_sentences(msg):
+    """
+    Parse a complete message into sentences
+    """
+    segmenter = SentenceSegmenter()
+    return segmenter.feed(msg) + segmenter.flush()
+
+def load_sound(path):
+    """
+    Load a WAV file into memory, ready to play at the output sample rate
+    """
+    sample_rate, wav = wavfile.read(path)
+    if wav.dtype == np.int16:
+        wav = wav.astype(np.float32) / np.iinfo(np.int16).max
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    wav = np.array(wav) * AUDIO_OUTPUT_VOLUME
+    if sample_rate != AUDIO_OUTPUT_SAMPLE_RATE:
+        wav = resample(wav, sample_rate, AUDIO_OUTPUT_SAMPLE_RATE)
+
+    return wav
+
+def prerender_msg(tts_client, tts_cache, tracer, msg):
+    """
+    Synthesize each sentence of a message and pin the audio in the cache, so play_msg() can play
+    it without waiting on the TTS server
+    """
+    for sentence in split_sentences(msg):
+        job_q = queue.Queue()
+        synthesize_sentence(tts_client, tts_cache, tracer, Interrupt(), sentence, job_q)
+        chunks = []
+        while (wav := job_q.get()) is not None:
+            chunks.append(wav)
+        if not chunks:
+            print(f"Could not prerender response: {sentence}", file=sys.stderr)
+            continue
+        tts_cache.pin(
+            TTSCache.key(sentence, TTS_VOICE, AUDIO_OUTPUT_VOLUME, AUDIO_OUTPUT_SAMPLE_RATE),
+            np.concatenate(chunks)
+        )
+
+def warm_up_chat(chat_backend):
+    """
+    Load the chat model into memory
+    """
+    chat_backend.load()
+
+def warm_up_tts(tts_client, tts_cache, tracer):
+    """
+    Make sure the TTS server is up and render the spoken action responses
+    """
+    tts_client.ping()
+    for response in ACTION_RESPONSES.values():
+        if response:
+            prerender_msg(tts_client, tts_cache, tracer, response)
 
 def play_msg(msg, tts_q, sound_semaphore):
     """
@@ -90,69 +2283,108 @@ def play_msg(msg, tts_q, sound_semaphore):
     # Only do this if TTS is enabled
     if TTS_ENABLE:
 
-        # Create regex pattern for parsing sentences
-        pattern = regex.compile(SENTENCE_REGEX, flags=regex.VERSION1)
-
         # Parse message into sentences and send them to the TTS thread
-        msg = msg.replace("\n", " ")
-        sentences = pattern.split(msg)
-        for sentence in sentences:
+        for sentence in split_sentences(msg):
             tts_q.put(sentence)
         tts_q.put(None)
 
         # Wait for sound to stop
         sound_semaphore.acquire(blocking=True)
 
-def query_chat(chat_client, msg, msg_history, q):
+def clear_history(msg_history, tts_q, sound_semaphore):
+    """
+    Action: forget the conversation so far
+    """
+    msg_history.clear()
+
+def stop_listening(msg_history, tts_q, sound_semaphore):
     """
-    Send message to chat backend (Ollama) and return response text
+    Action: go back to waiting for the wake phrase
     """
+    pass
 
-    # Create regex pattern for parsing sentences
-    pattern = regex.compile(SENTENCE_REGEX, flags=regex.VERSION1)
+def make_prompt(text):
+    """
+    Add instructions (e.g. to limit the reply length) to what the user said
+    """
+    if CHAT_MAX_REPLY_SENTENCES > 0:
+        return text + f". Your response must be {CHAT_MAX_REPLY_SENTENCES} sentences or fewer."
+    else:
+        return text
+
+def query_chat(msg, msg_history, q, tracer, stream):
+    """
+    Read the reply to a message from the chat stream (see ChatBackend.chat()) and send it to the
+    TTS queue. Closing the stream from another thread stops the reply early.
+    """
 
     # Add prompt to message history
     msg_history.push({
         "role": "user",
         "content": msg,
     })
-
-    # Query Ollama
-    stream = chat_client.chat(
-        model=OLLAMA_MODEL,
-        messages=msg_history.get(),
-        stream=True
+    tracer.set(prompt_tokens=msg_history.tokens())
+
+    # Parse reply for sentences and put them into the queue. The first chunk may be sent before
+    # the end of the first sentence so the speaker can start sooner.
+    reply = []
+    first_token_time = None
+    segmenter = SentenceSegmenter(
+        first_chunk_budget=TTS_FIRST_CHUNK_BUDGET_MS / 1000,
+        first_chunk_min_words=TTS_FIRST_CHUNK_MIN_WORDS,
+        first_chunk_max_words=TTS_FIRST_CHUNK_MAX_WORDS
     )
-
-    # Parse reply for sentences
-    reply = ""
-    sentences = deque([""])
-    for chunk in stream:
-
-        # Get the next string part from the stream
-        part = chunk["message"]["content"]
-        reply += part
-
-        # Parse sentences and put them into the queue
-        tmp_str = sentences[0] + part
-        tmp_sentences = pattern.split(tmp_str)
-        sentences[0] = tmp_sentences[0]
-        if len(tmp_sentences) > 1:
-            ret_sentence = sentences.popleft()
-            ret_sentence = ret_sentence.replace("\n", " ")
-            if TTS_ENABLE:
-                q.put(ret_sentence)
-            if DEBUG:
-                print(f"RECV: {ret_sentence}")
-            for tmp in tmp_sentences[1:]:
-                sentences.append(tmp)
+    try:
+        for chunk in stream:
+
+            # The last chunk says how much of the prompt had to be evaluated (the rest was cached)
+            # and whether the model had to be loaded first
+            if chunk.get("done"):
+                load_sec = chunk.get("load_duration", 0) / 1e9
+                tracer.set(
+                    prompt_eval_tokens=chunk.get("prompt_eval_count", 0),
+                    reply_tokens=chunk.get("eval_count", 0),
+                    llm_load=round(1000 * load_sec, 1)
+                )
+                if first_token_time is not None:
+                    cold = load_sec >= ChatBackend.COLD_LOAD_SEC
+                    tracer.mark(
+                        "llm_first_token_cold" if cold else "llm_first_token_warm",
+                        first_token_time
+                    )
+                if DEBUG:
+                    print(
+                        f"Prompt: {msg_history.tokens()} tokens (estimated), "
+                        f"{chunk.get('prompt_eval_count', 0)} evaluated. "
+                        f"Model load: {round(load_sec, 1)} sec"
+                    )
+
+            # Get the next string part from the stream
+            tracer.mark("llm_first_token")
+            if first_token_time is None:
+                first_token_time = time.monotonic()
+            part = chunk["message"]["content"]
+            reply.append(part)
+            for sentence in segmenter.feed(part):
+                tracer.mark("first_sentence")
+                if TTS_ENABLE:
+                    q.put(sentence)
+                if DEBUG:
+                    print(f"RECV: {sentence}")
+    except Exception as e:
+        print(f"Failed to get response from chat server: {e}", file=sys.stderr)
 
     # All done. Add final sentence and None delimiter.
+    tracer.mark("llm_done")
+    for sentence in segmenter.flush():
+        tracer.mark("first_sentence")
+        if TTS_ENABLE:
+            q.put(sentence)
+        if DEBUG:
+            print(f"RECV: {sentence}")
     if TTS_ENABLE:
-        q.put(sentences[0])
         q.put(None)
-    if DEBUG:
-        print(f"RECV: {sentences[0]}")
+    reply = "".join(reply)
 
     # Add reply to message history
     msg_history.push({
@@ -164,68 +2396,188 @@ def query_chat(chat_client, msg, msg_history, q):
     if DEBUG:
         print(f"Whole reply: {reply}")
 
-def start_chat_thread(in_q, tts_q, sound_semaphore):
+def start_chat_thread(
+    capture,
+    player,
+    tts_q,
+    sound_semaphore,
+    interrupt,
+    tts_client,
+    tts_cache,
+    tracer,
+    ready
+):
     """
-    Main chat thread: performs STT and sends queries to chat server.
+    Main chat thread: performs STT and sends queries to chat server. `ready` is set once
+    everything is loaded and we are listening.
     """
-
-    # Get sample rate
-    device_info = sd.query_devices(sd.default.device[0], "input")
-    sample_rate = int(device_info["default_samplerate"])
+    timestamp = time.time()
 
     # Display input device info
     if DEBUG:
-        print(f"Input device info: {json.dumps(device_info, indent=2)}")
-
-    # Load notification sound into memory
+        print(f"Input device info: {json.dumps(capture.device_info, indent=2)}")
+
+    # Load the models and sounds and warm up the servers, all at the same time
+    chat_backend = ChatBackend(
+        OLLAMA_SERVER_URL,
+        OLLAMA_MODEL,
+        options=OLLAMA_OPTIONS,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        first_token_timeout=CHAT_FIRST_TOKEN_TIMEOUT_SEC,
+        token_timeout=CHAT_TOKEN_TIMEOUT_SEC
+    )
+    startup = Startup(STARTUP_RETRY_SEC)
+    startup.add("vosk", lambda: Model(lang="en-us"), retry=True)
     if NOTIFICATION_PATH:
-        notification_sample_rate, notification_wav = wavfile.read(NOTIFICATION_PATH)
-        if notification_wav.dtype == np.int16:
-            notification_wav = notification_wav.astype(np.float32) / np.iinfo(np.int16).max
-        notification_wav = np.array(notification_wav) * AUDIO_OUTPUT_VOLUME
-        notification_wav = resampy.resample(
-            notification_wav,
-            notification_sample_rate,
-            AUDIO_OUTPUT_SAMPLE_RATE
-        )
+        startup.add("notification", lambda: load_sound(NOTIFICATION_PATH))
+    startup.add("ollama", lambda: warm_up_chat(chat_backend), retry=True)
+    if TTS_ENABLE:
+        startup.add("piper", lambda: warm_up_tts(tts_client, tts_cache, tracer), retry=True)
+    results = startup.run()
+    notification_wav = results.get("notification")
 
-    # Build the model
-    model = Model(lang="en-us")
-    recognizer = KaldiRecognizer(model, sample_rate)
+    # Stop the chat server from unloading the model between conversations
+    if OLLAMA_KEEP_WARM_SEC > 0:
+        chat_backend.start_keep_warm(OLLAMA_KEEP_WARM_SEC)
+
+    # Build the recognizer
+    model = results["vosk"]
+    recognizer = KaldiRecognizer(model, capture.sample_rate)
     recognizer.SetWords(False)
 
-    # Initialize Ollama client
-    chat_client = ollama.Client(host=OLLAMA_SERVER_URL)
+    # Listen for the wake phrase with a recognizer that only knows those words, which is cheaper
+    # to run and much less likely to mishear them
+    if WAKE_USE_GRAMMAR:
+        wake_recognizer = KaldiRecognizer(
+            model,
+            capture.sample_rate,
+            json.dumps(WAKE_PHRASES + ["[unk]"])
+        )
+        wake_recognizer.SetWords(False)
+    else:
+        wake_recognizer = recognizer
+
+    # Same for listening to the user talking over a reply (wake and stop phrases only)
+    if WAKE_USE_GRAMMAR:
+        barge_recognizer = KaldiRecognizer(
+            model,
+            capture.sample_rate,
+            json.dumps(WAKE_PHRASES + ACTION_STOP + ["[unk]"])
+        )
+        barge_recognizer.SetWords(False)
+    else:
+        barge_recognizer = recognizer
+    echo_gate = EchoGate(len(capture.block_samples), BARGE_IN_ECHO_MARGIN_DB)
+
+    # Only wake the recognizer up for speech
+    vad = None
+    if VAD_ENABLE:
+        vad = EnergyVAD(
+            capture.sample_rate,
+            len(capture.block_samples),
+            VAD_THRESHOLD_DB,
+            VAD_HANGOVER_MS,
+            VAD_PREROLL_MS
+        )
+
+    # Let the main thread know we are ready
+    if DEBUG:
+        print(f"Startup: {startup.report()}")
+        print(f"Startup time: {round(time.time() - timestamp, 1)} sec")
+    ready.set()
+
+    # Compile the wake and action phrases
+    wake_matcher = PhraseMatcher(PHRASE_MATCH_THRESHOLD)
+    wake_matcher.add("wake", WAKE_PHRASES)
+    action_matcher = PhraseMatcher(PHRASE_MATCH_THRESHOLD)
+    for action, phrases in ACTION_PHRASES.items():
+        action_matcher.add(action, phrases)
+    barge_matcher = PhraseMatcher(PHRASE_MATCH_THRESHOLD)
+    barge_matcher.add("wake", WAKE_PHRASES)
+    barge_matcher.add("stop", ACTION_STOP)
+
+    # Start on the reply while the user is still finishing their query. The reply is buffered by
+    # the stream until the final transcript confirms the guess (as a (message, stream) pair).
+    speculation = None
+
+    def speculate(text):
+        nonlocal speculation
+        if action_matcher.match(text)[0] is not None:
+            return
+        if speculation is not None:
+            speculation[1].close()
+        msg = make_prompt(text)
+        if DEBUG:
+            print(f"Speculating: {msg}")
+        speculation = (
+            msg,
+            chat_backend.chat(msg_history.peek({"role": "user", "content": msg}))
+        )
 
     # Main chat loop
-    msg_history = FixedSizeQueue(CHAT_MAX_HISTORY, CHAT_PREAMBLE)
+    msg_history = ChatHistory(
+        max_tokens=CHAT_MAX_HISTORY_TOKENS,
+        max_messages=CHAT_MAX_HISTORY,
+        low_water=CHAT_HISTORY_LOW_WATER,
+        preamble=CHAT_PREAMBLE,
+        keep_dropped=CHAT_SUMMARIZE_ENABLE
+    )
+    summarizer = None
+    if CHAT_SUMMARIZE_ENABLE:
+        summarizer = HistorySummarizer(chat_backend, msg_history, CHAT_SUMMARY_MAX_WORDS)
+    woken = False
     while True:
 
-        # Listen for wake word or phrase
-        timestamp = time.time()
-        text = wait_for_stt(in_q, recognizer)
-        if DEBUG:
-            print(f"Heard: {text}")
-        if text in WAKE_PHRASES:
+        # Listen for wake word or phrase, ignoring anything heard while we were busy (unless the
+        # user already said it to interrupt the last reply)
+        if not woken:
+            capture.clear()
+            wake_recognizer.Reset()
+            timestamp = time.time()
+            text = wait_for_stt(capture, wake_recognizer, vad=vad, matcher=wake_matcher)
             if DEBUG:
-                print(f"Wake phrase detected.")
-                print(f"STT time: {round(time.time() - timestamp, 1)} sec")
-        else:
-            continue
+                print(f"Heard: {text}")
+            if wake_matcher.match(text, suffix=True)[0] is not None:
+                if DEBUG:
+                    print(f"Wake phrase detected.")
+                    print(f"STT time: {round(time.time() - timestamp, 1)} sec")
+            else:
+                continue
+        woken = False
+
+        # Make way for the user's query
+        if summarizer is not None:
+            summarizer.stop()
 
-        # Play notification sound
+        # Play notification sound. We listen while it plays, so nothing said right after it is
+        # lost, and the echo gate keeps the sound itself out of the query. The marker ends the
+        # sound without waiting for it.
         if NOTIFICATION_PATH:
-            sd.play(
-                notification_wav,
-                samplerate=AUDIO_OUTPUT_SAMPLE_RATE,
-                device=AUDIO_OUTPUT_INDEX,
-                blocksize=2048
-            )
-            sd.wait()
+            player.write(notification_wav)
+            player.mark()
 
-        # Listen for query
+        # Listen for query (capture stream stays open, so nothing is lost after the wake phrase)
+        recognizer.Reset()
         timestamp = time.time()
-        text = wait_for_stt(in_q, recognizer)
+        text = wait_for_stt(
+            capture,
+            recognizer,
+            tracer,
+            vad,
+            VAD_QUERY_TIMEOUT_SEC,
+            on_stable=speculate if STT_SPECULATIVE_ENABLE else None,
+            echo_gate=echo_gate,
+            player=player
+        )
+
+        # Only keep the speculative reply if it was for what the user actually said
+        stream = None
+        if speculation is not None:
+            if speculation[0] == make_prompt(text):
+                stream = speculation[1]
+            else:
+                speculation[1].close()
+            speculation = None
         if text != "":
             if DEBUG:
                 print(f"Heard: {text}")
@@ -233,22 +2585,23 @@ def start_chat_thread(in_q, tts_q, sound_semaphore):
         else:
             if DEBUG:
                 print("No sound detected. Returning to wake word detection.")
+            tracer.discard()
             continue
 
         # Perform actions for particular phrases
-        if text in ACTION_CLEAR_HISTORY:
+        action, phrase, confidence = action_matcher.match(text)
+        if action is not None:
             if DEBUG:
-                print("ACTION: clearing history")
-            msg_history = FixedSizeQueue(CHAT_MAX_HISTORY, CHAT_PREAMBLE)
-            play_msg(
-                "OK. My chat history is cleared.",
-                tts_q,
-                sound_semaphore
-            )
-            continue
-        elif text in ACTION_STOP:
-            if DEBUG:
-                print("ACTION: stop listening")
+                print(f"ACTION: {action} (heard \"{phrase}\", confidence {round(confidence, 2)})")
+            tracer.set(action=action)
+            ACTION_HANDLERS[action](msg_history, tts_q, sound_semaphore)
+            if ACTION_RESPONSES.get(action):
+                play_msg(
+                    ACTION_RESPONSES[action],
+                    tts_q,
+                    sound_semaphore
+                )
+            tracer.end()
             continue
 
         # Default action: query chat backend
@@ -258,66 +2611,199 @@ def start_chat_thread(in_q, tts_q, sound_semaphore):
             wall_timestamp = time.time()
 
             # Send request with limited reply length. Sentences are added to TTS queue.
-            if CHAT_MAX_REPLY_SENTENCES > 0:
-                msg = text + \
-                    f". Your response must be {CHAT_MAX_REPLY_SENTENCES} sentences or fewer."
-            else:
-                msg = text
+            msg = make_prompt(text)
             if DEBUG:
-                print(f"Sending: {msg}")
-            timestamp = time.time()
-            query_chat(
-                chat_client,
-                msg,
-                msg_history,
-                tts_q
+                print(f"Sending: {msg}" + (" (speculative)" if stream is not None else ""))
+            tracer.set(action="query", speculative=stream is not None)
+
+            # Get the reply in the background, so we can listen for the user interrupting it
+            if stream is None:
+                stream = chat_backend.chat(msg_history.peek({"role": "user", "content": msg}))
+            worker = threading.Thread(
+                target=query_chat,
+                args=(msg, msg_history, tts_q, tracer, stream),
+                daemon=True
             )
-            if DEBUG:
-                print(f"LLM time: {round(time.time() - timestamp, 1)} sec")
+            worker.start()
+            barge_in = None
+            if BARGE_IN_ENABLE and TTS_ENABLE:
+                barge_in = wait_for_barge_in(
+                    capture,
+                    barge_recognizer,
+                    barge_matcher,
+                    echo_gate,
+                    player,
+                    lambda: sound_semaphore.acquire(blocking=False)
+                )
+
+            # Stop talking right away, then throw away the rest of the reply
+            if barge_in is not None:
+                if DEBUG:
+                    print(f"Interrupted: {barge_in[0]} (heard \"{barge_in[1]}\")")
+                tracer.set(barge_in=barge_in[0])
+                if interrupt.begin(sound_semaphore):
+                    player.flush()
+                    stream.close()
+                    worker.join()
+                    tts_q.put(FLUSH)
+                    sound_semaphore.acquire(blocking=True)
+                woken = barge_in[0] == "wake"
 
             # Wait for TTS thread to finish
-            if TTS_ENABLE:
+            elif TTS_ENABLE and not BARGE_IN_ENABLE:
                 sound_semaphore.acquire(blocking=True)
+            worker.join()
             if DEBUG:
                 print(f"Full query complete in {round(time.time() - wall_timestamp, 1)} sec")
+            record = tracer.end()
+            if DEBUG:
+                print(f"Trace: {json.dumps(record)}")
+
+            # Condense any messages that were dropped from the history while we are idle
+            if summarizer is not None and not woken:
+                summarizer.start()
 
-def start_tts_thread(tts_q, sound_q):
+def synthesize_sentence(tts_client, tts_cache, tracer, interrupt, msg, job_q):
     """
-    Wait for message in queue, send it to TTS server, then queue up sound to be played.
+    Send a sentence to the TTS server (unless it is in the cache) and put the audio in the job
+    queue, ready to play at the output sample rate. In streaming mode, audio is resampled and queued
+    in chunks as it arrives. None is put in the queue when the sentence is done. Gives up early if
+    the reply is interrupted.
+    """
+    try:
+
+        # Play straight from the cache if we have said this before
+        key = TTSCache.key(msg, TTS_VOICE, AUDIO_OUTPUT_VOLUME, AUDIO_OUTPUT_SAMPLE_RATE)
+        wav = tts_cache.get(key)
+        if wav is not None:
+            job_q.put(wav)
+            return
+
+        # Stream audio as it arrives from the TTS server
+        timestamp = time.monotonic()
+        resample_time = 0.0
+        if TTS_STREAMING:
+            resampler = None
+            chunks = []
+            stream = tts_client.synthesize_stream(msg)
+            for sample_rate, samples in stream:
+                if interrupt.is_set():
+                    stream.close()
+                    return
+                if not chunks:
+                    tracer.span("tts_first_chunk", time.monotonic() - timestamp)
+                wav = samples.astype(np.float32) / np.iinfo(np.int16).max * AUDIO_OUTPUT_VOLUME
+                if sample_rate != AUDIO_OUTPUT_SAMPLE_RATE:
+                    resample_timestamp = time.monotonic()
+                    if resampler is None:
+                        resampler = Resampler(
+                            sample_rate,
+                            AUDIO_OUTPUT_SAMPLE_RATE,
+                            RESAMPLE_QUALITY
+                        )
+                    wav = resampler.process(wav)
+                    resample_time += time.monotonic() - resample_timestamp
+                job_q.put(wav)
+                chunks.append(wav)
+            if resampler is not None:
+                wav = resampler.flush()
+                job_q.put(wav)
+                chunks.append(wav)
+            tracer.span("tts_request", time.monotonic() - timestamp - resample_time)
+            tracer.span("resample", resample_time)
+            if chunks:
+                tts_cache.put(key, np.concatenate(chunks), msg)
+            return
+
+        # Send message to TTS server
+        result = tts_client.synthesize(msg)
+        tracer.span("tts_request", time.monotonic() - timestamp)
+        if result is None or interrupt.is_set():
+            return
+
+        # Convert to float
+        sample_rate, wav = result
+        if wav.dtype == np.int16:
+            wav = wav.astype(np.float32) / np.iinfo(np.int16).max
+
+        # Adjust volume and resample
+        wav = np.array(wav) * AUDIO_OUTPUT_VOLUME
+        if sample_rate != AUDIO_OUTPUT_SAMPLE_RATE:
+            resample_timestamp = time.monotonic()
+            wav = resample(wav, sample_rate, AUDIO_OUTPUT_SAMPLE_RATE)
+            tracer.span("resample", time.monotonic() - resample_timestamp)
+        job_q.put(wav)
+        tts_cache.put(key, wav, msg)
+
+    except Exception as e:
+        print(f"Failed to synthesize sentence: {e}", file=sys.stderr)
+
+    finally:
+        job_q.put(None)
+
+def start_tts_thread(
+    tts_q,
+    order_q,
+    tts_client,
+    tts_cache,
+    tracer,
+    interrupt,
+    executor,
+    in_flight
+):
+    """
+    Wait for message in queue and hand it to the synthesis pool. Each sentence gets its own job
+    queue, and job queues are put in the order queue in the same order as the sentences so they
+    can be played back in order. Sentences are skipped while the reply is being interrupted.
     """
     while True:
-        while not tts_q.empty():
 
-            # Get message from queue
-            msg = tts_q.get()
-            if msg is None:
-                sound_q.put(None)
-                continue
+        # Block until there is a message in the queue
+        msg = tts_q.get()
+        if msg is SHUTDOWN:
+            order_q.put(SHUTDOWN)
+            return
+        if msg is None or msg is FLUSH:
+            order_q.put(msg)
+            continue
+        if interrupt.is_set():
+            continue
 
-            # Send message to TTS server
-            params = {"text": msg}
-            resp = requests.get(PIPER_URL, params=params)
-            if resp.status_code != 200:
-                raise RuntimeError(f"Failed to get response from TTS server: {resp.status_code}")
-
-            # Convert response to NumPy array and convert to float
-            sample_rate, wav = wavfile.read(io.BytesIO(resp.content))
-            if wav.dtype == np.int16:
-                wav = wav.astype(np.float32) / np.iinfo(np.int16).max
-
-            # Adjust volume and resample
-            wav = np.array(wav) * AUDIO_OUTPUT_VOLUME
-            if sample_rate != AUDIO_OUTPUT_SAMPLE_RATE:
-                wav = resampy.resample(
-                    wav,
-                    sample_rate,
-                    AUDIO_OUTPUT_SAMPLE_RATE
-                )
+        # Limit the number of requests sent to the TTS server at once
+        in_flight.acquire()
+        job_q = queue.Queue()
+        job = executor.submit(
+            synthesize_sentence,
+            tts_client,
+            tts_cache,
+            tracer,
+            interrupt,
+            msg,
+            job_q
+        )
+        job.add_done_callback(lambda _: in_flight.release())
+        order_q.put(job_q)
 
-            # Put sound in queue
+def start_reorder_thread(order_q, sound_q):
+    """
+    Forward audio from each sentence's job queue (in sentence order) to the sound queue. Audio is
+    forwarded as it arrives, so a sentence can start playing before it is fully synthesized.
+    """
+    while True:
+        job_q = order_q.get()
+        if job_q is SHUTDOWN:
+            sound_q.put(SHUTDOWN)
+            return
+        if job_q is None or job_q is FLUSH:
+            sound_q.put(job_q)
+            continue
+
+        # Put sound in queue
+        while True:
+            wav = job_q.get()
+            if wav is None:
+                break
             sound_q.put(wav)
-        
-        time.sleep(0.1)
 
 def digital_write(ctrl, pin, value):
     """
@@ -329,26 +2815,57 @@ def digital_write(ctrl, pin, value):
         elif platform == "jetson":
             ctrl.output(pin, value)
 
-def start_sound_thread(sound_q, sound_semaphore, servo_notify):
+def start_sound_thread(sound_q, sound_semaphore, interrupt, servo_notify, player, tracer):
     """
-    Wait for sound binary in queue, then play it through the speaker.
+    Wait for sound binary in queue, then send it to the speaker. Sound keeps streaming to the
+    speaker until the end of the reply, when we wait for playback to finish. If the reply is
+    interrupted, everything is thrown away until the FLUSH marker arrives.
     """
+    playing = False
+    underruns = player.underruns
     while True:
-        while not sound_q.empty():
-            wav = sound_q.get()
-            if wav is None:
-                sound_semaphore.release()
+
+        # Block until there is a sound in the queue
+        wav = sound_q.get()
+        if wav is SHUTDOWN:
+            return
+
+        # Interrupted reply has been flushed out of the pipeline
+        if wav is FLUSH:
+            player.flush()
+            if playing:
+                digital_write(servo_notify, SERVO_NOTIFY_PIN, 0)
+                playing = False
+            underruns = player.underruns
+            interrupt.end()
+            sound_semaphore.release()
+            continue
+
+        # End of reply: wait for the speaker to catch up
+        if wav is None:
+            if interrupt.is_set():
                 continue
-            digital_write(servo_notify, SERVO_NOTIFY_PIN, 1)
-            sd.play(
-                wav,
-                samplerate=AUDIO_OUTPUT_SAMPLE_RATE,
-                device=AUDIO_OUTPUT_INDEX,
-                blocksize=2048
-            )
-            sd.wait()
-            digital_write(servo_notify, SERVO_NOTIFY_PIN, 0)
-        time.sleep(0.1)
+            player.mark().wait()
+            if playing:
+                tracer.mark("first_audio", player.active_since)
+                digital_write(servo_notify, SERVO_NOTIFY_PIN, 0)
+                playing = False
+            if DEBUG and player.underruns > underruns:
+                print(f"Output underruns: {player.underruns - underruns}")
+            underruns = player.underruns
+            with interrupt.lock:
+                if not interrupt.is_set():
+                    sound_semaphore.release()
+            continue
+
+        # Play sound (unless the chat thread has just started interrupting the reply)
+        with interrupt.lock:
+            if interrupt.is_set():
+                continue
+            if not playing:
+                digital_write(servo_notify, SERVO_NOTIFY_PIN, 1)
+                playing = True
+            player.write(wav)
 
 #---------------------------------------------------------------------------------------------------
 # Main
@@ -366,43 +2883,31 @@ def main():
         Jetson.GPIO.setup(SERVO_NOTIFY_PIN, Jetson.GPIO.OUT)
         servo_notify = Jetson.GPIO
 
+    capture = None
+    player = None
+    pipeline = None
+    tracer = LatencyTracer(TRACE_PATH)
     try:
 
         # Set Vosk logging
         if not DEBUG:
             SetLogLevel(-1)
 
-        # Set the input and output devices
-        sd.default.device = [AUDIO_INPUT_INDEX, AUDIO_OUTPUT_INDEX]
+        # Open the microphone once and keep it open for the life of the program
+        capture = create_capture()
+        capture.start()
 
-        # Set up queue and callback
-        in_q = queue.Queue()
-
-        # Semaphore used to notify main thread when TTS is done playing
-        sound_semaphore = threading.BoundedSemaphore(1)
-        sound_semaphore.acquire()
+        # Same for the speaker, so sentences play back to back
+        player = create_player()
+        player.start()
 
-        # Start TTS and sound threads
-        tts_q = queue.Queue()
-        if TTS_ENABLE:
-            sound_q = queue.Queue()
-            tts_thread = threading.Thread(
-                target=start_tts_thread, 
-                args=(tts_q, sound_q)
-            )
-            tts_thread.start()
-            sound_thread = threading.Thread(
-                target=start_sound_thread, 
-                args=(sound_q, sound_semaphore, servo_notify)
-            )
-            sound_thread.start()
+        # Start the chat, TTS, and sound threads
+        pipeline = Pipeline(capture, player, tracer, servo_notify)
+        pipeline.start()
 
-        # Start STT and chat thread
-        chat_thread = threading.Thread(
-            target=start_chat_thread, 
-            args=(in_q, tts_q, sound_semaphore)
-        )
-        chat_thread.start()
+        # Only welcome the user once everything is loaded
+        pipeline.wait_until_ready()
+        print(WELCOME_MSG)
 
         # Keep main thread running
         while True:
@@ -412,7 +2917,23 @@ def main():
     except KeyboardInterrupt:
         print("Main program stopped")
     finally:
-        servo_notify.close()
+
+        # Stop the threads, then the audio streams
+        if pipeline is not None:
+            pipeline.stop()
+        if (DEBUG or TRACE_PATH) and tracer.count > 0:
+            print(tracer.summary())
+        if capture is not None:
+            capture.stop()
+        if player is not None:
+            player.stop()
+
+        # Release GPIO
+        if servo_notify is not None:
+            if platform == "pi":
+                servo_notify.close()
+            elif platform == "jetson":
+                servo_notify.cleanup()
 
 #---------------------------------------------------------------------------------------------------
 # Settings
@@ -430,8 +2951,11 @@ Welcome to Hopper Chat! Say the wake phrase "Hey, Hopper" and ask a question.
 Press 'ctrl+c' to exit.
 """
 
-# Parsing sentences
-SENTENCE_REGEX = r"(?<=\.|\?|\!|\:|\#|\.\.\.|\n|\n\n)\s+(?=[A-Z0-9]|\Z)"
+# Sentinel put in the TTS and sound queues to tell the worker threads to exit
+SHUTDOWN = object()
+
+# Marker put in the TTS queue after an interrupted reply (everything before it is thrown away)
+FLUSH = object()
 
 # Parse configuration file
 PARSER = argparse.ArgumentParser(description="Hopper Chat")
@@ -453,8 +2977,41 @@ config.read(CONFIG_FILE_PATH)
 DEBUG = config.getboolean("settings", "DEBUG", fallback=False)
 AUDIO_INPUT_INDEX = config.getint("settings", "AUDIO_INPUT_INDEX", fallback=0)
 AUDIO_OUTPUT_INDEX = config.getint("settings", "AUDIO_OUTPUT_INDEX", fallback=1)
+AUDIO_INPUT_BUFFER_SEC = config.getfloat("settings", "AUDIO_INPUT_BUFFER_SEC", fallback=10.0)
+AUDIO_INPUT_BACKEND = config.get(
+    "settings",
+    "AUDIO_INPUT_BACKEND",
+    fallback="sounddevice"
+).strip('"')
+AUDIO_INPUT_WAV_PATHS = [
+    path for path in parse_config_list(config.get("settings", "AUDIO_INPUT_WAV_PATHS", fallback=""))
+    if path
+]
+AUDIO_INPUT_WAV_GAP_SEC = config.getfloat("settings", "AUDIO_INPUT_WAV_GAP_SEC", fallback=1.5)
+AUDIO_INPUT_WAV_LOOP = config.getboolean("settings", "AUDIO_INPUT_WAV_LOOP", fallback=False)
+AUDIO_OUTPUT_BACKEND = config.get(
+    "settings",
+    "AUDIO_OUTPUT_BACKEND",
+    fallback="sounddevice"
+).strip('"')
+AUDIO_OUTPUT_FILE_PATH = config.get(
+    "settings",
+    "AUDIO_OUTPUT_FILE_PATH",
+    fallback="./hopper-out.wav"
+).strip('"')
+AUDIO_CLOCK_SPEED = config.getfloat("settings", "AUDIO_CLOCK_SPEED", fallback=1.0)
 AUDIO_OUTPUT_VOLUME = config.getfloat("settings", "AUDIO_OUTPUT_VOLUME", fallback=1.0)
 AUDIO_OUTPUT_SAMPLE_RATE = config.getint("settings", "AUDIO_OUTPUT_SAMPLE_RATE", fallback=48000)
+VAD_ENABLE = config.getboolean("settings", "VAD_ENABLE", fallback=True)
+VAD_THRESHOLD_DB = config.getfloat("settings", "VAD_THRESHOLD_DB", fallback=12.0)
+VAD_HANGOVER_MS = config.getint("settings", "VAD_HANGOVER_MS", fallback=600)
+VAD_PREROLL_MS = config.getint("settings", "VAD_PREROLL_MS", fallback=300)
+VAD_QUERY_TIMEOUT_SEC = config.getfloat("settings", "VAD_QUERY_TIMEOUT_SEC", fallback=5.0)
+STT_ENDPOINT_SILENCE_MS = config.getint("settings", "STT_ENDPOINT_SILENCE_MS", fallback=700)
+STT_MAX_UTTERANCE_SEC = config.getfloat("settings", "STT_MAX_UTTERANCE_SEC", fallback=15.0)
+STT_SPECULATIVE_ENABLE = config.getboolean("settings", "STT_SPECULATIVE_ENABLE", fallback=False)
+STT_SPECULATIVE_MS = config.getint("settings", "STT_SPECULATIVE_MS", fallback=300)
+RESAMPLE_QUALITY = config.get("settings", "RESAMPLE_QUALITY", fallback="medium").strip('"')
 NOTIFICATION_PATH = config.get(
     "settings",
     "NOTIFICATION_PATH",
@@ -462,13 +3019,53 @@ NOTIFICATION_PATH = config.get(
 ).strip('"')
 SERVER_IP = config.get("settings", "SERVER_IP", fallback="127.0.0.1").strip('"')
 CHAT_MAX_HISTORY = config.getint("settings", "CHAT_MAX_HISTORY", fallback=20)
+CHAT_MAX_HISTORY_TOKENS = config.getint("settings", "CHAT_MAX_HISTORY_TOKENS", fallback=2048)
+CHAT_HISTORY_LOW_WATER = config.getfloat("settings", "CHAT_HISTORY_LOW_WATER", fallback=0.5)
+CHAT_SUMMARIZE_ENABLE = config.getboolean("settings", "CHAT_SUMMARIZE_ENABLE", fallback=False)
+CHAT_SUMMARY_MAX_WORDS = config.getint("settings", "CHAT_SUMMARY_MAX_WORDS", fallback=100)
 CHAT_MAX_REPLY_SENTENCES = config.getint("settings", "CHAT_MAX_REPLY_SENTENCES", fallback=0)
+CHAT_MAX_TOKENS_PER_SENTENCE = config.getint(
+    "settings",
+    "CHAT_MAX_TOKENS_PER_SENTENCE",
+    fallback=60
+)
+CHAT_FIRST_TOKEN_TIMEOUT_SEC = config.getfloat(
+    "settings",
+    "CHAT_FIRST_TOKEN_TIMEOUT_SEC",
+    fallback=30.0
+)
+CHAT_TOKEN_TIMEOUT_SEC = config.getfloat("settings", "CHAT_TOKEN_TIMEOUT_SEC", fallback=10.0)
 OLLAMA_SERVER_PORT = config.getint("settings", "OLLAMA_SERVER_PORT", fallback=10802)
 OLLAMA_MODEL = config.get("settings", "OLLAMA_MODEL", fallback="llama3:8b").strip('"')
+OLLAMA_KEEP_ALIVE = config.get("settings", "OLLAMA_KEEP_ALIVE", fallback="").strip('"')
+OLLAMA_KEEP_WARM_SEC = config.getfloat("settings", "OLLAMA_KEEP_WARM_SEC", fallback=0.0)
+OLLAMA_NUM_CTX = config.getint("settings", "OLLAMA_NUM_CTX", fallback=0)
+OLLAMA_NUM_THREAD = config.getint("settings", "OLLAMA_NUM_THREAD", fallback=0)
+OLLAMA_NUM_PREDICT = config.getint("settings", "OLLAMA_NUM_PREDICT", fallback=0)
+OLLAMA_TEMPERATURE = config.getfloat("settings", "OLLAMA_TEMPERATURE", fallback=-1.0)
 TTS_ENABLE = config.getboolean("settings", "TTS_ENABLE", fallback=True)
 PIPER_SERVER_PORT = config.getint("settings", "PIPER_SERVER_PORT", fallback=10803)
+PIPER_CONNECT_TIMEOUT = config.getfloat("settings", "PIPER_CONNECT_TIMEOUT", fallback=3.0)
+PIPER_READ_TIMEOUT = config.getfloat("settings", "PIPER_READ_TIMEOUT", fallback=30.0)
+PIPER_RETRIES = config.getint("settings", "PIPER_RETRIES", fallback=3)
+PIPER_RETRY_BACKOFF = config.getfloat("settings", "PIPER_RETRY_BACKOFF", fallback=0.5)
+TTS_STREAMING = config.getboolean("settings", "TTS_STREAMING", fallback=True)
+TTS_FIRST_CHUNK_BUDGET_MS = config.getint("settings", "TTS_FIRST_CHUNK_BUDGET_MS", fallback=0)
+TTS_FIRST_CHUNK_MIN_WORDS = config.getint("settings", "TTS_FIRST_CHUNK_MIN_WORDS", fallback=3)
+TTS_FIRST_CHUNK_MAX_WORDS = config.getint("settings", "TTS_FIRST_CHUNK_MAX_WORDS", fallback=12)
+TTS_MAX_IN_FLIGHT = max(1, config.getint("settings", "TTS_MAX_IN_FLIGHT", fallback=3))
+TTS_VOICE = config.get("settings", "TTS_VOICE", fallback="en_US-lessac-low").strip('"')
+TTS_CACHE_SIZE = config.getint("settings", "TTS_CACHE_SIZE", fallback=64)
+TTS_CACHE_MAX_MB = config.getfloat("settings", "TTS_CACHE_MAX_MB", fallback=8.0)
+TTS_CACHE_DIR = config.get("settings", "TTS_CACHE_DIR", fallback="").strip('"')
+TTS_CACHE_DISK_MAX_CHARS = config.getint("settings", "TTS_CACHE_DISK_MAX_CHARS", fallback=80)
 TTS_MODEL_SAMPLE_RATE = config.getint("settings", "TTS_MODEL_SAMPLE_RATE", fallback=22050)
 CHAT_PREAMBLE = config.get("settings", "CHAT_PREAMBLE", fallback="").strip('"')
+WAKE_USE_GRAMMAR = config.getboolean("settings", "WAKE_USE_GRAMMAR", fallback=True)
+PHRASE_MATCH_THRESHOLD = config.getfloat("settings", "PHRASE_MATCH_THRESHOLD", fallback=0.8)
+STARTUP_RETRY_SEC = config.getfloat("settings", "STARTUP_RETRY_SEC", fallback=5.0)
+BARGE_IN_ENABLE = config.getboolean("settings", "BARGE_IN_ENABLE", fallback=True)
+BARGE_IN_ECHO_MARGIN_DB = config.getfloat("settings", "BARGE_IN_ECHO_MARGIN_DB", fallback=10.0)
 
 # Parse the lists
 WAKE_PHRASES = parse_config_list(
@@ -481,6 +3078,44 @@ ACTION_STOP = parse_config_list(
     config.get("settings", "ACTION_STOP", fallback=["nevermind"])
 )
 SERVO_NOTIFY_PIN = config.getint("settings", "SERVO_NOTIFY_PIN", fallback=-1)
+TRACE_PATH = config.get("settings", "TRACE_PATH", fallback="").strip('"')
+
+# What to say after performing an action (blank to say nothing)
+ACTION_RESPONSES = {
+    "clear_history": config.get(
+        "settings",
+        "RESPONSE_CLEAR_HISTORY",
+        fallback="OK. My chat history is cleared."
+    ).strip('"'),
+    "stop": config.get("settings", "RESPONSE_STOP", fallback="").strip('"'),
+}
+
+# Actions: the phrases that trigger them and what to do
+ACTION_PHRASES = {
+    "clear_history": ACTION_CLEAR_HISTORY,
+    "stop": ACTION_STOP,
+}
+ACTION_HANDLERS = {
+    "clear_history": clear_history,
+    "stop": stop_listening,
+}
+
+# Ollama takes keep_alive as a number of seconds or as a duration (e.g. "30m")
+try:
+    OLLAMA_KEEP_ALIVE = float(OLLAMA_KEEP_ALIVE)
+except ValueError:
+    OLLAMA_KEEP_ALIVE = OLLAMA_KEEP_ALIVE or None
+
+# Model options sent with each request (anything not set uses the model's default). The reply
+# length limit comes from CHAT_MAX_REPLY_SENTENCES unless it is set directly.
+OLLAMA_OPTIONS = {
+    "num_ctx": OLLAMA_NUM_CTX,
+    "num_thread": OLLAMA_NUM_THREAD,
+    "num_predict": OLLAMA_NUM_PREDICT or CHAT_MAX_REPLY_SENTENCES * CHAT_MAX_TOKENS_PER_SENTENCE,
+}
+OLLAMA_OPTIONS = {name: value for name, value in OLLAMA_OPTIONS.items() if value > 0}
+if OLLAMA_TEMPERATURE >= 0:
+    OLLAMA_OPTIONS["temperature"] = OLLAMA_TEMPERATURE
 
 # Construct server URL strings
 OLLAMA_SERVER_URL = f"http://{SERVER_IP}:{OLLAMA_SERVER_PORT}"
@@ -503,7 +3138,6 @@ except FileNotFoundError:
 # Entrypoint
 
 if __name__ == "__main__":
-    print(WELCOME_MSG)
     print(f"TTS: {TTS_ENABLE}")
     print(f"Servo notify pin: {SERVO_NOTIFY_PIN}")
     print(f"Platform: {platform}")
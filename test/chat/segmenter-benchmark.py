@@ -0,0 +1,119 @@
+"""
+Sentence segmenter benchmark
+
+Compares the streaming SentenceSegmenter in hopper-chat.py against the old approach of re-running
+SENTENCE_REGEX on the current sentence for every token. Tokens are simulated by splitting text into
+short random pieces, like the chunks streamed back from Ollama.
+
+Installation:
+
+	python -m pip install regex
+
+Run from the root of the repository:
+
+	python test/chat/segmenter-benchmark.py
+"""
+
+from collections import deque
+import importlib.util
+import os
+import random
+import sys
+import time
+
+import regex
+
+# Old sentence regex (hopper-chat.py used this before SentenceSegmenter)
+SENTENCE_REGEX = r"(?<=\.|\?|\!|\:|\#|\.\.\.|\n|\n\n)\s+(?=[A-Z0-9]|\Z)"
+
+# Settings
+NUM_RUNS = 5
+SENTENCE_LENGTHS = [10, 50, 200, 1000]  # Words per sentence
+
+def load_hopper_chat():
+    """
+    Import hopper-chat.py as a module (its name is not a valid module name)
+    """
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "hopper-chat.py")
+    sys.argv = [path]
+    spec = importlib.util.spec_from_file_location("hopper_chat", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def make_tokens(words_per_sentence, num_sentences=10):
+    """
+    Build a reply and split it into tokens of 1-6 characters
+    """
+    random.seed(0)
+    words = ["robot", "the", "Baymax", "is", "a", "companion", "with", "3.5", "sensors", "and"]
+    sentences = []
+    for _ in range(num_sentences):
+        sentence = " ".join(random.choice(words) for _ in range(words_per_sentence))
+        sentences.append(sentence.capitalize() + random.choice([".", "!", "?"]))
+    text = " ".join(sentences)
+    tokens = []
+    i = 0
+    while i < len(text):
+        num = random.randint(1, 6)
+        tokens.append(text[i:i + num])
+        i += num
+
+    return tokens
+
+def split_regex(tokens):
+    """
+    Old approach (from query_chat()): re-split the current sentence on every token
+    """
+    pattern = regex.compile(SENTENCE_REGEX, flags=regex.VERSION1)
+    out = []
+    reply = ""
+    sentences = deque([""])
+    for part in tokens:
+        reply += part
+        tmp_sentences = pattern.split(sentences[0] + part)
+        sentences[0] = tmp_sentences[0]
+        if len(tmp_sentences) > 1:
+            out.append(sentences.popleft().replace("\n", " "))
+            for tmp in tmp_sentences[1:]:
+                sentences.append(tmp)
+    out.extend(sentences)
+
+    return out
+
+def split_segmenter(hopper_chat, tokens):
+    """
+    New approach: feed tokens to SentenceSegmenter
+    """
+    segmenter = hopper_chat.SentenceSegmenter()
+    out = []
+    for part in tokens:
+        out.extend(segmenter.feed(part))
+    out.extend(segmenter.flush())
+
+    return out
+
+def benchmark(func, tokens):
+    """
+    Return the average time per token in microseconds
+    """
+    func(tokens)
+    timestamp = time.perf_counter()
+    for _ in range(NUM_RUNS):
+        func(tokens)
+
+    return 1e6 * (time.perf_counter() - timestamp) / NUM_RUNS / len(tokens)
+
+def main():
+    hopper_chat = load_hopper_chat()
+
+    print(f"{'Words/sentence':>14} {'Tokens':>8} {'Regex (us/token)':>18} {'Segmenter (us/token)':>22}")
+    for words in SENTENCE_LENGTHS:
+        tokens = make_tokens(words)
+        regex_time = benchmark(split_regex, tokens)
+        segmenter_time = benchmark(lambda t: split_segmenter(hopper_chat, t), tokens)
+        print(f"{words:>14} {len(tokens):>8} {regex_time:>18.2f} {segmenter_time:>22.2f}")
+
+if __name__ == "__main__":
+    main()
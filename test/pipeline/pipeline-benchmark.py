@@ -0,0 +1,229 @@
+"""
+Pipeline benchmark
+
+Runs the real Hopper Chat pipeline (STT -> chat -> TTS -> sound threads) without any hardware or
+servers. Recorded WAV files are fed in as microphone audio and played audio goes to a null sink (the
+"wav" and "null" audio backends), while local stand-in servers emulate Ollama's streaming /api/chat
+endpoint and Piper's GET endpoint. Reports time-to-first-audio (from the end of the user's speech)
+and the other per-stage latencies, so regressions can be caught on any machine.
+
+Record two WAV files (any sample rate): one saying a wake phrase from the config (e.g.
+"hey digit") and one asking a question. Then run from the root of the repository:
+
+	python test/pipeline/pipeline-benchmark.py --wav wake.wav question.wav --runs 5
+
+Vosk needs to download its model the first time it runs.
+"""
+
+import argparse
+import configparser
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from scipy.io import wavfile
+
+# Reply sent back by the stand-in Ollama server
+REPLY = "Baymax is a healthcare companion robot from Big Hero 6. He was built by Tadashi " \
+    "Hamada to help people, and he is known for his soft, inflatable body. Would you like " \
+    "to know more about how he was designed?"
+
+# Settings
+TOKEN_SIZE = 4                  # Characters per streamed token
+TTS_SAMPLE_RATE = 22050         # Sample rate of the stand-in Piper server
+TTS_SEC_PER_CHAR = 0.06         # Length of synthesized audio per character of text
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hopper Chat pipeline benchmark")
+    parser.add_argument("--wav", nargs="+", required=True, help="WAV files to use as microphone input, in order")
+    parser.add_argument("--runs", type=int, default=5, help="Number of times to play the WAV files")
+    parser.add_argument("--gap", type=float, default=1.5, help="Seconds of silence after each WAV file")
+    parser.add_argument("--speed", type=float, default=1.0, help="Audio clock speed (2.0 = twice real time)")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Seconds before the first LLM token")
+    parser.add_argument("--token-rate", type=float, default=20.0, help="LLM tokens per second")
+    parser.add_argument("--tts-delay", type=float, default=0.1, help="Seconds of TTS delay per request")
+    parser.add_argument("--tts-rtf", type=float, default=0.05, help="TTS seconds of delay per second of audio")
+    parser.add_argument("--config", default="hopper-chat.conf", help="Base configuration file")
+    parser.add_argument("--trace", default="", help="Also save traces to this JSON lines file")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Max seconds to wait for each run")
+    return parser.parse_args()
+
+def load_hopper_chat(config_path):
+    """
+    Import hopper-chat.py as a module (its name is not a valid module name) with the given config
+    """
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "hopper-chat.py")
+    sys.argv = [path, "-c", config_path]
+    spec = importlib.util.spec_from_file_location("hopper_chat", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+#---------------------------------------------------------------------------------------------------
+# Stand-in servers
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def make_ollama_handler(args, stats):
+    """
+    Emulates Ollama's streaming /api/chat endpoint (newline-delimited JSON) and /api/generate
+    (only used to load the model at startup)
+    """
+    class OllamaHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path == "/api/generate":
+                data = json.dumps({"model": request["model"], "response": "", "done": True}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+
+            # Stream the reply a few characters at a time
+            time.sleep(args.ttft)
+            tokens = [REPLY[i:i + TOKEN_SIZE] for i in range(0, len(REPLY), TOKEN_SIZE)]
+            for token in tokens:
+                chunk = {"model": request["model"], "message": {"role": "assistant", "content": token}, "done": False}
+                self.wfile.write((json.dumps(chunk) + "\n").encode())
+                time.sleep(1.0 / args.token_rate)
+            chunk = {
+                "model": request["model"],
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                "prompt_eval_count": sum(len(m["content"]) for m in request["messages"]) // 4,
+                "eval_count": len(tokens),
+            }
+            self.wfile.write((json.dumps(chunk) + "\n").encode())
+            stats["llm_requests"] += 1
+
+        def log_message(self, *args):
+            pass
+
+    return OllamaHandler
+
+def make_piper_handler(args, stats):
+    """
+    Emulates the Piper HTTP server: GET /?text=... returns a WAV file
+    """
+    class PiperHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            from urllib.parse import urlparse, parse_qs
+            text = parse_qs(urlparse(self.path).query).get("text", [""])[0]
+            duration = len(text) * TTS_SEC_PER_CHAR
+            time.sleep(args.tts_delay + duration * args.tts_rtf)
+
+            # A quiet tone as long as the text would take to say
+            t = np.arange(int(duration * TTS_SAMPLE_RATE)) / TTS_SAMPLE_RATE
+            wav = (0.1 * np.sin(2 * np.pi * 220 * t) * np.iinfo(np.int16).max).astype(np.int16)
+            buf = io.BytesIO()
+            wavfile.write(buf, TTS_SAMPLE_RATE, wav)
+            data = buf.getvalue()
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            stats["tts_requests"] += 1
+            stats["tts_audio_sec"] += duration
+
+        def log_message(self, *args):
+            pass
+
+    return PiperHandler
+
+#---------------------------------------------------------------------------------------------------
+# Main
+
+def main():
+    args = parse_args()
+    stats = {"llm_requests": 0, "tts_requests": 0, "tts_audio_sec": 0.0}
+
+    # Start stand-in servers
+    ollama_server = start_server(make_ollama_handler(args, stats))
+    piper_server = start_server(make_piper_handler(args, stats))
+
+    # Point the config at them (both servers must share an IP address)
+    config = configparser.ConfigParser(inline_comment_prefixes="#")
+    config.read(args.config)
+    if not config.has_section("settings"):
+        config.add_section("settings")
+    config.set("settings", "DEBUG", "False")
+    config.set("settings", "SERVER_IP", "127.0.0.1")
+    config.set("settings", "OLLAMA_SERVER_PORT", str(ollama_server.server_port))
+    config.set("settings", "PIPER_SERVER_PORT", str(piper_server.server_port))
+    config.set("settings", "TTS_ENABLE", "True")
+    config.set("settings", "TTS_CACHE_DIR", "")
+    config.set("settings", "TRACE_PATH", args.trace)
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".conf", delete=False)
+    config.write(config_file)
+    config_file.close()
+    hopper_chat = load_hopper_chat(config_file.name)
+    os.unlink(config_file.name)
+
+    # Audio in and out without hardware
+    capture = hopper_chat.WavFileCapture(args.wav, gap_sec=args.gap, speed=args.speed)
+    player = hopper_chat.NullPlayer(hopper_chat.AUDIO_OUTPUT_SAMPLE_RATE, speed=args.speed)
+    tracer = hopper_chat.LatencyTracer(args.trace)
+    pipeline = hopper_chat.Pipeline(capture, player, tracer)
+
+    # Start everything up
+    hopper_chat.SetLogLevel(-1)
+    timestamp = time.monotonic()
+    capture.start()
+    player.start()
+    pipeline.start()
+    pipeline.wait_until_ready()
+    print(f"Startup: {round(time.monotonic() - timestamp, 1)} sec")
+
+    # Play the clips and wait for each interaction to finish
+    timestamp = time.monotonic()
+    for run in range(args.runs):
+        count = tracer.count
+        capture.replay()
+        deadline = time.monotonic() + args.timeout
+        while tracer.count == count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if tracer.count == count:
+            print(f"Run {run + 1}: timed out (was the wake phrase recognized?)")
+        else:
+            print(f"Run {run + 1}: first audio after {round(tracer_last(tracer, 'first_audio'))} ms")
+    elapsed = time.monotonic() - timestamp
+
+    # Shut down and report
+    pipeline.stop()
+    capture.stop()
+    player.stop()
+    print()
+    print(tracer.summary())
+    print()
+    print(f"Wall time: {round(elapsed, 1)} sec")
+    print(f"LLM requests: {stats['llm_requests']}, TTS requests: {stats['tts_requests']}")
+    print(f"Audio played: {round(player.played / player.sample_rate, 1)} sec")
+    print(f"TTS throughput: {round(stats['tts_audio_sec'] / elapsed, 2)} sec of audio per sec")
+    print(f"Output underruns: {player.underruns}, input samples dropped: {capture.ring.dropped}")
+
+def tracer_last(tracer, name):
+    values = tracer.history.get(name)
+    return values[-1] if values else float("nan")
+
+if __name__ == "__main__":
+    main()
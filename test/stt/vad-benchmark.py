@@ -0,0 +1,113 @@
+"""
+VAD benchmark
+
+Measures how much CPU the speech recognizer uses while Hopper Chat waits for the wake phrase, with
+and without the energy VAD in front of it. Audio is fed to Vosk as fast as possible and CPU time is
+reported as a percentage of one core at real time (i.e. the idle load on the device). By default
+the input is background noise only; pass a WAV file to mix in some speech.
+
+Run from the root of the repository (Vosk needs to download its model the first time it runs):
+
+	python test/stt/vad-benchmark.py
+	python test/stt/vad-benchmark.py --wav question.wav
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.io import wavfile
+
+# Settings
+SAMPLE_RATE = 16000
+BLOCK_SEC = 0.1                 # Same block size as AudioCapture
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hopper Chat VAD benchmark")
+    parser.add_argument("--seconds", type=float, default=60.0, help="Seconds of audio to process")
+    parser.add_argument("--noise-db", type=float, default=-55.0, help="Background noise level (dBFS)")
+    parser.add_argument("--wav", default="", help="Optional speech to mix in every 20 seconds")
+    return parser.parse_args()
+
+def load_hopper_chat():
+    """
+    Import hopper-chat.py as a module (its name is not a valid module name)
+    """
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "hopper-chat.py")
+    sys.argv = [path]
+    spec = importlib.util.spec_from_file_location("hopper_chat", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def make_audio(hopper_chat, args):
+    """
+    Background noise with optional speech every 20 seconds, as 16-bit blocks
+    """
+    rng = np.random.default_rng(0)
+    num = int(args.seconds * SAMPLE_RATE)
+    audio = rng.standard_normal(num) * 10 ** (args.noise_db / 20)
+    if args.wav:
+        capture = hopper_chat.WavFileCapture(sample_rate=SAMPLE_RATE)
+        rate, wav = wavfile.read(args.wav)
+        speech = capture.convert(wav, rate).astype(np.float64) / 32768
+        for start in range(SAMPLE_RATE, num - len(speech), 20 * SAMPLE_RATE):
+            audio[start:start + len(speech)] += speech
+    audio = np.clip(audio * 32768, -32768, 32767).astype(np.int16)
+    block_size = int(BLOCK_SEC * SAMPLE_RATE)
+
+    return [audio[i:i + block_size] for i in range(0, num - block_size + 1, block_size)]
+
+def run(hopper_chat, model, blocks, use_vad):
+    """
+    Feed the blocks to a recognizer (gated by the VAD if enabled). Returns the CPU time, how many
+    blocks were decoded, and what was heard.
+    """
+    recognizer = hopper_chat.KaldiRecognizer(model, SAMPLE_RATE)
+    vad = hopper_chat.EnergyVAD(SAMPLE_RATE, len(blocks[0])) if use_vad else None
+    decoded = 0
+    heard = []
+    timestamp = time.process_time()
+    for block in blocks:
+        segment_end = False
+        if vad is not None:
+            state = vad.process(block)
+            if state == vad.SILENCE:
+                continue
+            elif state == vad.START:
+                for preroll in vad.take_preroll():
+                    recognizer.AcceptWaveform(preroll)
+                    decoded += 1
+            segment_end = state == vad.END
+        accepted = recognizer.AcceptWaveform(block.tobytes())
+        decoded += 1
+        if accepted or segment_end:
+            result = recognizer.Result() if accepted else recognizer.FinalResult()
+            text = json.loads(result).get("text", "")
+            if text:
+                heard.append(text)
+    elapsed = time.process_time() - timestamp
+
+    return elapsed, decoded, heard
+
+def main():
+    args = parse_args()
+    hopper_chat = load_hopper_chat()
+    hopper_chat.SetLogLevel(-1)
+    model = hopper_chat.Model(lang="en-us")
+    blocks = make_audio(hopper_chat, args)
+    duration = len(blocks) * BLOCK_SEC
+
+    print(f"{round(duration)} sec of audio, noise at {args.noise_db} dBFS")
+    print(f"{'':<12} {'CPU (% of core)':>16} {'Blocks decoded':>16}   Heard")
+    for name, use_vad in [("Vosk only", False), ("VAD + Vosk", True)]:
+        elapsed, decoded, heard = run(hopper_chat, model, blocks, use_vad)
+        print(f"{name:<12} {100 * elapsed / duration:>16.1f} {decoded:>16}   {heard}")
+
+if __name__ == "__main__":
+    main()
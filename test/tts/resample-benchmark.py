@@ -0,0 +1,98 @@
+"""
+Resample benchmark
+
+Compares the polyphase resampler in hopper-chat.py against resampy (which hopper-chat used to
+use) on a Piper TTS clip. Reports time per second of audio, speed relative to real time, and the
+difference from resampy's output.
+
+Installation:
+
+	python -m pip install resampy
+
+Run from the root of the repository:
+
+	python test/tts/resample-benchmark.py
+"""
+
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+import resampy
+from scipy.io import wavfile
+
+# Settings
+WAV_PATH = os.path.join(os.path.dirname(__file__), "out.wav")
+OUTPUT_SAMPLE_RATE = 48000
+CHUNK_SIZE = 1024               # Input samples per chunk in streaming mode
+NUM_RUNS = 5
+
+def load_hopper_chat():
+    """
+    Import hopper-chat.py as a module (its name is not a valid module name)
+    """
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "hopper-chat.py")
+    sys.argv = [path]
+    spec = importlib.util.spec_from_file_location("hopper_chat", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def benchmark(name, func, duration, reference=None):
+    """
+    Run func a few times and print the average time and error compared to the reference
+    """
+    out = func()
+    timestamp = time.perf_counter()
+    for _ in range(NUM_RUNS):
+        func()
+    elapsed = (time.perf_counter() - timestamp) / NUM_RUNS
+    msg = f"{name:<28} {1000 * elapsed / duration:8.2f} ms/sec {duration / elapsed:8.1f}x real time"
+    if reference is not None:
+        num = min(len(out), len(reference))
+        err = out[:num] - reference[:num]
+        snr = 10 * np.log10(np.sum(reference[:num] ** 2) / max(np.sum(err ** 2), 1e-20))
+        msg += f"   SNR vs. resampy: {snr:5.1f} dB"
+    print(msg)
+
+    return out
+
+def main():
+    hopper_chat = load_hopper_chat()
+
+    # Load test clip
+    sample_rate, wav = wavfile.read(WAV_PATH)
+    wav = wav.astype(np.float32) / np.iinfo(np.int16).max
+    duration = len(wav) / sample_rate
+    print(f"Clip: {WAV_PATH} ({round(duration, 1)} sec at {sample_rate} Hz -> {OUTPUT_SAMPLE_RATE} Hz)")
+
+    # Baseline
+    reference = benchmark(
+        "resampy",
+        lambda: resampy.resample(wav, sample_rate, OUTPUT_SAMPLE_RATE),
+        duration
+    )
+
+    # Polyphase resampler (whole clip and streaming) at each quality setting
+    for quality in hopper_chat.Resampler.QUALITY:
+        hopper_chat.RESAMPLE_QUALITY = quality
+        benchmark(
+            f"polyphase ({quality})",
+            lambda: hopper_chat.resample(wav, sample_rate, OUTPUT_SAMPLE_RATE),
+            duration,
+            reference
+        )
+
+        def stream():
+            resampler = hopper_chat.Resampler(sample_rate, OUTPUT_SAMPLE_RATE, quality)
+            out = [resampler.process(wav[i:i + CHUNK_SIZE]) for i in range(0, len(wav), CHUNK_SIZE)]
+            out.append(resampler.flush())
+            return np.concatenate(out)
+
+        benchmark(f"polyphase stream ({quality})", stream, duration, reference)
+
+if __name__ == "__main__":
+    main()